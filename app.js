@@ -6,6 +6,14 @@ let editingId = null;
 let currentMonth = new Date();
 let filterStart = null;
 let filterEnd = null;
+const TOMAS_PAGE_SIZE = 50;
+let tomasCursor = null;
+let tomasLoading = false;
+let tomasRequest = 0;
+let diasComTomas = new Set();
+let diasRequest = 0;
+const selecionados = new Set();
+let streamAtivo = false;
 
 function logout() {
   fetch("/auth/logout", { method: "POST" })
@@ -66,6 +74,7 @@ function renderList() {
     } else {
       item.innerHTML = `
         <div>
+          <input type="checkbox" class="med-select" data-id="${med.id}" ${selecionados.has(String(med.id)) ? "checked" : ""}>
           <div class="med-title">${med.nome}</div>
           <div class="med-meta">${med.dose} • ${med.hora}${med.data ? ' • ' + med.data : ''}</div>
         </div>
@@ -94,6 +103,14 @@ function renderList() {
   list.querySelectorAll(".take-btn").forEach(btn => {
     btn.addEventListener("click", () => tomarAgora(btn.dataset.id));
   });
+  list.querySelectorAll(".med-select").forEach(box => {
+    box.addEventListener("change", () => {
+      if (box.checked) selecionados.add(box.dataset.id);
+      else selecionados.delete(box.dataset.id);
+      updateBulkBar();
+    });
+  });
+  updateBulkBar();
 
   if (nextEl) {
     const next = getNextMed(sorted);
@@ -210,11 +227,72 @@ function apagarMedicamento(id) {
       if (ok && data.ok) {
         medicamentos = medicamentos.filter(m => String(m.id) !== String(id));
         renderList();
+        // Sem rede o service worker guarda a operação e responde queued
+        if (data.queued) setFormMsg("Sem ligação. O medicamento será apagado mais tarde.");
       }
     })
-    .catch(() => {});
+    .catch(() => setFormMsg("Erro de ligação ao servidor"));
+}
+
+function updateBulkBar() {
+  const bar = document.getElementById("bulkBar");
+  if (!bar) return;
+  const ids = new Set(medicamentos.map(m => String(m.id)));
+  [...selecionados].forEach(id => { if (!ids.has(id)) selecionados.delete(id); });
+  bar.style.display = selecionados.size ? "flex" : "none";
 }
 
+function enviarOperacoes(ops) {
+  return fetch("/api/medicamentos/batch", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ ops })
+  }).then(r => r.json());
+}
+
+function aplicarResultados(ops, data) {
+  (data.results || []).forEach((res, i) => {
+    const op = ops[i];
+    if (!res.ok || (op.op !== "delete" && op.op !== "take")) return;
+    medicamentos = medicamentos.filter(m => String(m.id) !== String(op.id));
+    selecionados.delete(String(op.id));
+  });
+  renderList();
+}
+
+function executarEmLote(ops) {
+  return enviarOperacoes(ops)
+    .then(data => {
+      aplicarResultados(ops, data);
+      if (ops.some(op => op.op === "take") && !streamAtivo) carregarTomas();
+      const falhas = (data.results || []).filter(r => !r.ok).length;
+      if (falhas) setFormMsg(`${falhas} operação(ões) falharam`);
+      else setFormMsg(data.queued ? "Sem ligação. As alterações serão enviadas mais tarde." : "");
+    })
+    .catch(() => setFormMsg("Erro de ligação ao servidor"));
+}
+
+function tomarSelecionados() {
+  const nota = pedirNota();
+  executarEmLote([...selecionados].map(id => ({ op: "take", id: +id, nota })));
+}
+
+function apagarSelecionados() {
+  executarEmLote([...selecionados].map(id => ({ op: "delete", id: +id })));
+}
+
+window.addEventListener("online", () => {
+  // Fila do service worker (alterações feitas offline com a réplica local)
+  navigator.serviceWorker?.controller?.postMessage({ type: "sync" });
+});
+
+navigator.serviceWorker?.addEventListener("message", e => {
+  if (e.data && e.data.type === "synced") {
+    carregarMedicamentos();
+    carregarTomas();
+  }
+});
+
 function carregarMedicamentos() {
   fetch("/api/medicamentos")
     .then(r => {
@@ -286,29 +364,94 @@ function tomarAgora(id) {
       if (ok && data.ok) {
         medicamentos = medicamentos.filter(m => String(m.id) !== String(id));
         renderList();
-        carregarTomas();
-        setFormMsg(`Registado e removido: ${med.nome}`);
+        if (!streamAtivo) carregarTomas();
+        setFormMsg(data.queued ? "Sem ligação. A toma será registada mais tarde." : `Registado e removido: ${med.nome}`);
       }
     })
-    .catch(() => {});
+    .catch(() => setFormMsg("Erro de ligação ao servidor"));
 }
 
-function carregarTomas() {
+function tomasParams() {
   const month = currentMonth.toISOString().slice(0, 7);
   const params = new URLSearchParams();
   if (filterStart) params.set("start", filterStart);
   if (filterEnd) params.set("end", filterEnd);
   if (!filterStart && !filterEnd) params.set("month", month);
-  fetch(`/api/tomas?${params.toString()}`)
+  return params;
+}
+
+function carregarTomas() {
+  tomasCursor = null;
+  tomasRequest += 1;
+  carregarPaginaTomas(tomasRequest, true);
+  carregarDiasCalendario();
+}
+
+function dataLocal(d) {
+  const pad = n => String(n).padStart(2, "0");
+  return `${d.getFullYear()}-${pad(d.getMonth() + 1)}-${pad(d.getDate())}`;
+}
+
+// Dias com tomas em toda a grelha do calendário, independentes das páginas
+// de tomas carregadas na lista.
+function carregarDiasCalendario() {
+  const year = currentMonth.getFullYear();
+  const month = currentMonth.getMonth();
+  const startDay = new Date(year, month, 1).getDay();
+  const daysInMonth = new Date(year, month + 1, 0).getDate();
+  const cells = Math.ceil((startDay + daysInMonth) / 7) * 7;
+  const params = new URLSearchParams({
+    start: dataLocal(new Date(year, month, 1 - startDay)),
+    end: dataLocal(new Date(year, month, cells - startDay))
+  });
+  const requestId = ++diasRequest;
+  renderCalendar();
+  fetch(`/api/tomas/days?${params.toString()}`)
     .then(r => r.json())
     .then(data => {
-      if (Array.isArray(data)) tomas = data;
+      if (requestId !== diasRequest || !data || !Array.isArray(data.days)) return;
+      diasComTomas = new Set(data.days);
       renderCalendar();
-      renderTomasList();
     })
     .catch(() => {});
 }
 
+function carregarMaisTomas() {
+  if (!tomasCursor || tomasLoading) return;
+  carregarPaginaTomas(tomasRequest, false);
+}
+
+function carregarPaginaTomas(requestId, reset) {
+  const params = tomasParams();
+  params.set("limit", TOMAS_PAGE_SIZE);
+  if (!reset && tomasCursor) params.set("cursor", tomasCursor);
+  tomasLoading = true;
+  fetch(`/api/tomas?${params.toString()}`)
+    .then(r => r.json())
+    .then(data => {
+      // Ignora respostas de um filtro/mês entretanto substituído
+      if (requestId !== tomasRequest || !data || !Array.isArray(data.items)) return;
+      tomas = reset ? data.items : tomas.concat(data.items);
+      tomasCursor = data.next_cursor || null;
+      renderTomasList();
+    })
+    .catch(() => {})
+    .finally(() => {
+      if (requestId === tomasRequest) tomasLoading = false;
+    });
+}
+
+function observarFimTomas() {
+  const list = document.getElementById("tomasList");
+  if (!list || !("IntersectionObserver" in window)) return;
+  const sentinel = document.createElement("div");
+  sentinel.id = "tomasSentinel";
+  list.insertAdjacentElement("afterend", sentinel);
+  new IntersectionObserver(entries => {
+    if (entries.some(e => e.isIntersecting)) carregarMaisTomas();
+  }).observe(sentinel);
+}
+
 function renderTomasList() {
   const list = document.getElementById("tomasList");
   const empty = document.getElementById("tomasEmpty");
@@ -368,15 +511,12 @@ function renderCalendar() {
     days.push({ num: n, muted: true, date: new Date(year, month + 1, n) });
   }
 
-  const daysWithTomas = new Set(tomas.map(t => t.data));
-
   days.forEach(d => {
     const cell = document.createElement("div");
     cell.className = `cal-day${d.muted ? " muted" : ""}`;
-    const iso = d.date.toISOString().slice(0, 10);
     cell.innerHTML = `
       <div class="cal-num">${d.num}</div>
-      ${daysWithTomas.has(iso) ? '<div class="cal-dot"></div>' : ''}
+      ${diasComTomas.has(dataLocal(d.date)) ? '<div class="cal-dot"></div>' : ''}
     `;
     grid.appendChild(cell);
   });
@@ -416,13 +556,7 @@ function limparFiltro() {
 }
 
 function exportarHistorico() {
-  const params = new URLSearchParams();
-  if (filterStart) params.set("start", filterStart);
-  if (filterEnd) params.set("end", filterEnd);
-  if (!filterStart && !filterEnd) {
-    const month = currentMonth.toISOString().slice(0, 7);
-    params.set("month", month);
-  }
+  const params = tomasParams();
   window.location.href = `/api/tomas/export?${params.toString()}`;
 }
 
@@ -461,30 +595,84 @@ function getNextMed(list) {
   return candidate ? `${candidate.nome} • ${candidate.dose} • às ${candidate.hora} (${day})` : null;
 }
 
-setInterval(() => {
-  const agora = new Date();
-  const h = agora.getHours();
-  const m = agora.getMinutes();
-  const minuteKey = `${h}:${m}`;
+function verificarLembretes() {
+  // O servidor devolve só os medicamentos agendados para o último minuto
+  // Os horários são hora local: o servidor compara com a hora deste dispositivo
+  const tz = new Date().getTimezoneOffset();
+  fetch(`/api/reminders/due?since=1&window=0&tz_offset=${tz}`)
+    .then(r => r.json())
+    .then(due => {
+      if (!Array.isArray(due)) return;
+      due.forEach(med => {
+        const key = `${med.id}-${med.agendado_em}`;
+        if (lastAlertKey === key) return;
+        lastAlertKey = key;
+        alertaTexto.innerText =
+          `Está na hora de tomar ${med.nome} (${med.dose})`;
+        alerta.style.display = "flex";
+        som.play();
+        notifyNow(med);
+        currentAlertMed = med;
+      });
+    })
+    .catch(() => {});
+}
 
-  medicamentos.forEach(med => {
-    if (!med.hora) return;
-    const [hh, mm] = med.hora.split(":");
-    if (+hh === h && +mm === m) {
-      const key = `${med.id}-${minuteKey}`;
-      if (lastAlertKey === key) return;
-      lastAlertKey = key;
-      alertaTexto.innerText =
-        `Está na hora de tomar ${med.nome} (${med.dose})`;
-      alerta.style.display = "flex";
-      som.play();
-      notifyNow(med);
-      currentAlertMed = med;
-    }
+setInterval(verificarLembretes, 60000);
+
+function tomaVisivel(t) {
+  if (filterStart || filterEnd) {
+    return (!filterStart || t.data >= filterStart) && (!filterEnd || t.data <= filterEnd);
+  }
+  return t.data.startsWith(currentMonth.toISOString().slice(0, 7));
+}
+
+function upsertPorId(lista, item) {
+  const idx = lista.findIndex(x => String(x.id) === String(item.id));
+  if (idx >= 0) lista[idx] = item;
+  else lista.push(item);
+}
+
+function ligarStream() {
+  // Feed SSE só quando o servidor o tem ligado (STREAM_ENABLED, injetado em APP_CONFIG)
+  const stream = typeof APP_CONFIG !== "undefined" && APP_CONFIG.stream;
+  if (!stream || !("EventSource" in window)) return;
+  const es = new EventSource("/api/stream");
+  es.onopen = () => { streamAtivo = true; };
+  es.onerror = () => { streamAtivo = false; };
+  es.addEventListener("created", e => {
+    upsertPorId(medicamentos, JSON.parse(e.data));
+    renderList();
+  });
+  es.addEventListener("updated", e => {
+    if (editingId !== null) return;
+    upsertPorId(medicamentos, JSON.parse(e.data));
+    renderList();
   });
-}, 60000);
+  es.addEventListener("deleted", e => {
+    const { id } = JSON.parse(e.data);
+    medicamentos = medicamentos.filter(m => String(m.id) !== String(id));
+    renderList();
+  });
+  es.addEventListener("taken", e => {
+    const t = JSON.parse(e.data);
+    diasComTomas.add(t.data);
+    renderCalendar();
+    if (!tomaVisivel(t)) return;
+    upsertPorId(tomas, t);
+    tomas.sort((a, b) => (b.data + b.hora).localeCompare(a.data + a.hora) || b.id - a.id);
+    renderTomasList();
+  });
+  es.addEventListener("reset", () => {
+    // Eventos perdidos: volta a carregar as listas completas
+    carregarMedicamentos();
+    carregarTomas();
+  });
+}
 
+ligarStream();
 carregarMedicamentos();
+observarFimTomas();
 carregarTomas();
 updateNotifBtn();
 setDefaultDate();
@@ -527,7 +715,9 @@ function fecharAlerta() {
         dose: med.dose,
         nota
       })
-    }).then(() => carregarTomas());
+    }).then(() => {
+      if (!streamAtivo) carregarTomas();
+    });
     currentAlertMed = null;
   }
 }
@@ -1,23 +1,85 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, send_from_directory
+import time
+import sys
+STARTUP_T0 = time.perf_counter()
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from contextlib import contextmanager
 import zipfile
 import os
+import atexit
+import threading
 try:
     from dotenv import load_dotenv
 except Exception:
     load_dotenv = None
-from datetime import datetime
+from datetime import datetime, date, timezone
 import csv
-from sqlalchemy import text
-import pandas as pd
+from sqlalchemy import text, func, tuple_, event, inspect, select, union_all, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached, Session, aliased
+import sqlite3
 import io
+import base64
+import tempfile
+import uuid
+import hashlib
+from collections import OrderedDict
+import queue
+from collections import deque
+from datetime import timedelta
 try:
-    from authlib.integrations.flask_client import OAuth
+    import brotli
 except Exception:
-    OAuth = None
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import gzip
+import json
+import mimetypes
+import re
+import click
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# --- Relatório de arranque ---
+# Tempo e memória gastos em cada fase do import deste módulo, por worker.
+STARTUP_PHASES = []
+_startup_last = STARTUP_T0
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS devolve bytes, Linux devolve KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def startup_phase(name):
+    """Regista a duração da fase que termina agora."""
+    global _startup_last
+    now = time.perf_counter()
+    STARTUP_PHASES.append({
+        'phase': name,
+        'ms': round((now - _startup_last) * 1000, 1),
+        'max_rss_kb': max_rss_kb(),
+        'modules': len(sys.modules),
+    })
+    _startup_last = now
+
+def startup_report():
+    return {
+        'pid': os.getpid(),
+        'total_ms': round((_startup_last - STARTUP_T0) * 1000, 1),
+        'phases': list(STARTUP_PHASES),
+    }
+
+startup_phase('imports')
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"
@@ -26,22 +88,196 @@ if load_dotenv:
 app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID', '')
 app.config['GOOGLE_CLIENT_SECRET'] = os.getenv('GOOGLE_CLIENT_SECRET', '')
 PUBLIC_MODE = os.getenv('PUBLIC_MODE', 'true').lower() in ('1', 'true', 'yes', 'on')
-
-oauth = OAuth(app) if OAuth else None
-if oauth:
-    oauth.register(
-        name='google',
-        client_id=app.config['GOOGLE_CLIENT_ID'],
-        client_secret=app.config['GOOGLE_CLIENT_SECRET'],
-        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-        client_kwargs={'scope': 'openid email profile'}
-    )
+# Proxies reversos de confiança à frente da app. Com 0 (omissão) os cabeçalhos
+# X-Forwarded-* são ignorados e remote_addr é o endereço da ligação.
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS > 0:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+_oauth = None
+
+def get_oauth():
+    """Cliente OAuth Google, importado e registado só no primeiro uso."""
+    global _oauth
+    if _oauth is None:
+        if not app.config['GOOGLE_CLIENT_ID'] or not app.config['GOOGLE_CLIENT_SECRET']:
+            return None
+        try:
+            from authlib.integrations.flask_client import OAuth
+        except Exception:
+            return None
+        oauth = OAuth(app)
+        oauth.register(
+            name='google',
+            client_id=app.config['GOOGLE_CLIENT_ID'],
+            client_secret=app.config['GOOGLE_CLIENT_SECRET'],
+            server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+            client_kwargs={'scope': 'openid email profile'}
+        )
+        _oauth = oauth
+    return _oauth
 
 # --- Configuração Database ---
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Perfil de desempenho SQLite (SQLITE_TUNING=false desativa). Com DATABASE_URL
+# a apontar para PostgreSQL as PRAGMAs são ignoradas e só o pool é configurado.
+SQLITE_TUNING = os.getenv('SQLITE_TUNING', 'true').lower() in ('1', 'true', 'yes', 'on')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+SQLITE_PRAGMAS = (
+    ('journal_mode', os.getenv('SQLITE_JOURNAL_MODE', 'WAL')),
+    ('synchronous', os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ('cache_size', int(os.getenv('SQLITE_CACHE_SIZE', '-20000'))),
+    ('mmap_size', int(os.getenv('SQLITE_MMAP_SIZE', '268435456'))),
+    ('busy_timeout', SQLITE_BUSY_TIMEOUT),
+    ('temp_store', 'MEMORY'),
+)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+        return {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT / 1000, 'check_same_thread': False},
+        }
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+@event.listens_for(Engine, 'connect')
+def sqlite_on_connect(dbapi_connection, connection_record):
+    if not SQLITE_TUNING or not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 db = SQLAlchemy(app)
 
+# --- Métricas por pedido ---
+# Desligadas por omissão: sem METRICS_ENABLED não se registam hooks nenhuns.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes', 'on')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '10'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class RequestMetrics:
+    """Agregados por rota em memória, exportados em formato Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}     # (rota, método, status) -> n
+        self.routes = {}       # rota -> agregados
+
+    def observe(self, route, method, status, duration, sql_count, sql_time, size, n_plus_one):
+        with self._lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            r = self.routes.get(route)
+            if r is None:
+                r = self.routes[route] = {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0,
+                    'sql_count': 0, 'sql_time': 0.0, 'bytes': 0, 'n_plus_one': 0
+                }
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    r['buckets'][i] += 1
+            r['count'] += 1
+            r['sum'] += duration
+            r['sql_count'] += sql_count
+            r['sql_time'] += sql_time
+            r['bytes'] += size or 0
+            r['n_plus_one'] += 1 if n_plus_one else 0
+
+    def render(self):
+        def label(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"')
+        lines = ['# TYPE http_requests_total counter']
+        with self._lock:
+            for (route, method, status), n in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{route="{label(route)}",method="{method}",status="{status}"}} {n}')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for route, r in sorted(self.routes.items()):
+                rl = label(route)
+                for bound, n in zip(LATENCY_BUCKETS, r['buckets']):
+                    lines.append(f'http_request_duration_seconds_bucket{{route="{rl}",le="{bound}"}} {n}')
+                lines.append(f'http_request_duration_seconds_bucket{{route="{rl}",le="+Inf"}} {r["count"]}')
+                lines.append(f'http_request_duration_seconds_sum{{route="{rl}"}} {r["sum"]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{route="{rl}"}} {r["count"]}')
+            for name, key, fmt in (
+                ('http_sql_queries_total', 'sql_count', '{}'),
+                ('http_sql_duration_seconds_total', 'sql_time', '{:.6f}'),
+                ('http_response_bytes_total', 'bytes', '{}'),
+                ('http_n_plus_one_total', 'n_plus_one', '{}'),
+            ):
+                lines.append(f'# TYPE {name} counter')
+                for route, r in sorted(self.routes.items()):
+                    lines.append(f'{name}{{route="{label(route)}"}} {fmt.format(r[key])}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+if METRICS_ENABLED:
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def metrics_before_cursor(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            conn.info.setdefault('metrics_t0', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def metrics_after_cursor(conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context() or not conn.info.get('metrics_t0'):
+            return
+        elapsed = time.perf_counter() - conn.info['metrics_t0'].pop()
+        sql = g.setdefault('sql_stats', {'count': 0, 'time': 0.0, 'statements': {}})
+        sql['count'] += 1
+        sql['time'] += elapsed
+        sql['statements'][statement] = sql['statements'].get(statement, 0) + 1
+
+    @app.before_request
+    def metrics_start():
+        g.metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def metrics_finish(response):
+        t0 = g.pop('metrics_t0', None)
+        if t0 is None:
+            return response
+        duration = time.perf_counter() - t0
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        sql = g.pop('sql_stats', {'count': 0, 'time': 0.0, 'statements': {}})
+        repeated = max(sql['statements'].values(), default=0)
+        n_plus_one = repeated > N_PLUS_ONE_THRESHOLD
+        if n_plus_one:
+            app.logger.warning('Possível N+1 em %s: mesma query repetida %d vezes', route, repeated)
+        size = None if response.is_streamed else response.content_length
+        request_metrics.observe(route, request.method, response.status_code, duration,
+                                sql['count'], sql['time'], size, n_plus_one)
+        if METRICS_SERVER_TIMING:
+            response.headers['Server-Timing'] = (
+                f'app;dur={duration * 1000:.1f}, '
+                f'db;dur={sql["time"] * 1000:.1f};desc="{sql["count"]} queries"'
+            )
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return Response('Não autorizado\n', status=401, mimetype='text/plain')
+        return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # --- Login Manager ---
 login_manager = LoginManager()
 login_manager.login_view = 'login_page'
@@ -74,19 +310,20 @@ def login_or_public(fn):
         return fn(*args, **kwargs)
     return wrapper
 
-_public_user_id = None
-
 def get_public_user():
-    global _public_user_id
-    if _public_user_id:
-        return User.query.get(_public_user_id)
+    user_id = app_cache.get('public_user_id')
+    if user_id:
+        user = get_user_cached(user_id)
+        if user:
+            return user
+        app_cache.pop('public_user_id')
     user = User.query.filter_by(email='public@local').first()
     if not user:
         user = User(email='public@local')
         user.set_password(os.urandom(12).hex())
         db.session.add(user)
         db.session.commit()
-    _public_user_id = user.id
+    app_cache.set('public_user_id', user.id)
     return user
 
 def effective_user():
@@ -100,23 +337,506 @@ def parse_date_ymd(value):
     except Exception:
         return None
 
-def get_sqlite_db_path():
-    uri = app.config.get('SQLALCHEMY_DATABASE_URI', '')
-    if uri.startswith('sqlite:///'):
-        path = uri.replace('sqlite:///', '', 1)
-        if not os.path.isabs(path):
-            path = os.path.join(app.root_path, path)
-        return path
+def parse_datetime(data, hora):
+    """Combina data (YYYY-MM-DD) e hora (HH:MM[:SS]) num datetime, ou None."""
+    if not data or not hora:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(f"{data} {hora}", fmt)
+        except ValueError:
+            continue
     return None
 
+def month_bounds(month):
+    """Devolve ('YYYY-MM-01', primeiro dia do mês seguinte) para 'YYYY-MM', ou None."""
+    try:
+        first = datetime.strptime(month, "%Y-%m").date()
+    except (TypeError, ValueError):
+        return None
+    if first.month == 12:
+        nxt = date(first.year + 1, 1, 1)
+    else:
+        nxt = date(first.year, first.month + 1, 1)
+    return first.isoformat(), nxt.isoformat()
+
+EXPORT_CHUNK_SIZE = 1000
+
+def iter_csv(header, rows, delimiter=','):
+    """Gera o CSV em blocos de texto, linha a linha, sem o montar em memória."""
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter)
+    writer.writerow(header)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n % 100 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def stream_download(chunks, mimetype, download_name):
+    """Resposta em streaming com o contexto do pedido ativo no gerador."""
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={download_name}'}
+    )
+
+# --- Exportações colunares ---
+# Parquet e Arrow IPC precisam do pyarrow (opcional, importado no primeiro
+# uso); NDJSON não tem dependências. As linhas vêm do cursor da query e são
+# escritas em row groups de EXPORT_ROW_GROUP_SIZE.
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', '50000'))
+COLUMNAR_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+_pyarrow = None
+
+def get_pyarrow():
+    """Módulos (pyarrow, pyarrow.parquet), ou None se o pyarrow não estiver instalado."""
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return None
+        _pyarrow = (pyarrow, pyarrow.parquet)
+    return _pyarrow
+
+def arrow_schema(pa, model, columns):
+    """Schema Arrow a partir dos tipos das colunas do modelo."""
+    fields = []
+    for name in columns:
+        column = model.__table__.c[name]
+        if isinstance(column.type, db.Integer):
+            type_ = pa.int64()
+        elif isinstance(column.type, db.DateTime):
+            type_ = pa.timestamp('s')
+        elif isinstance(column.type, db.Date):
+            type_ = pa.date32()
+        elif isinstance(column.type, db.Float):
+            type_ = pa.float64()
+        elif isinstance(column.type, db.Boolean):
+            type_ = pa.bool_()
+        else:
+            type_ = pa.string()
+        fields.append(pa.field(name, type_, nullable=column.nullable))
+    return pa.schema(fields)
+
+def iter_ndjson(columns, rows):
+    """Um objeto JSON por linha, em blocos de texto."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def iter_columnar(tipo, model, columns, rows):
+    """Gera os bytes de um ficheiro Parquet/Arrow/NDJSON a partir de tuplos.
+
+    `rows` são tuplos pela ordem de `columns`; cada row group é escrito e
+    enviado antes de ler o seguinte.
+    """
+    if tipo == 'ndjson':
+        for chunk in iter_ndjson(columns, rows):
+            yield chunk.encode()
+        return
+    pa, pq = get_pyarrow()
+    schema = arrow_schema(pa, model, columns)
+    sink = ZipStreamSink()
+    if tipo == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+
+    def write(batch):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)]
+        table = pa.Table.from_arrays(arrays, schema=schema)
+        if tipo == 'parquet':
+            writer.write_table(table, row_group_size=len(batch))
+        else:
+            writer.write_table(table)
+
+    batch = []
+    for row in rows:
+        batch.append(tuple(row))
+        if len(batch) >= EXPORT_ROW_GROUP_SIZE:
+            write(batch)
+            batch = []
+            yield sink.drain()
+    if batch:
+        write(batch)
+    writer.close()
+    yield sink.drain()
+
+def columnar_download(tipo, model, columns, rows, name):
+    """Resposta em streaming para um tipo colunar; erro 400 se faltar o pyarrow."""
+    if tipo != 'ndjson' and get_pyarrow() is None:
+        return jsonify({'ok': False, 'message': 'Exportação em Parquet/Arrow requer o pyarrow'}), 400
+    mimetype, ext = COLUMNAR_FORMATS[tipo]
+    return stream_download(iter_columnar(tipo, model, columns, rows), mimetype, f"{name}.{ext}")
+
+def get_sqlite_db_path():
+    # O Flask-SQLAlchemy resolve caminhos relativos na pasta instance/;
+    # o URL do engine já tem o caminho final.
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        return None
+    return os.path.abspath(url.database)
+
+
+class LRUCache:
+    """Cache LRU em memória, thread-safe, com TTL opcional e contadores."""
+
+    def __init__(self, max_size=256, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self.ttl and time.monotonic() - item[1] > self.ttl):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# --- Cache partilhada ---
+# Caches com namespace sobre um backend: "memory" (LRU por processo, por
+# omissão), "sqlite" (ficheiro partilhado pelos workers da máquina) ou
+# "redis" (partilhado entre máquinas; requer o pacote redis). Limpar um
+# namespace incrementa a sua versão: as chaves antigas deixam de ser lidas
+# e expiram sozinhas.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+CACHE_PREFIX = os.getenv('CACHE_PREFIX', 'lembreme')
+CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH') or os.path.join(app.instance_path, 'cache.db')
+CACHE_SQLITE_MAX_ENTRIES = int(os.getenv('CACHE_SQLITE_MAX_ENTRIES', '50000'))
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# Quanto tempo um worker reutiliza a versão de um namespace lida do backend partilhado
+CACHE_VERSION_TTL = 1.0
+
+class MemoryCacheBackend:
+    """Backend em processo (LRU). As versões dos namespaces ficam fora do LRU."""
+
+    def __init__(self, max_size):
+        self._lru = LRUCache(max_size)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self._lru.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires and time.time() > expires:
+            self._lru.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._lru.set(key, (value, time.time() + ttl if ttl else None))
+
+    def delete(self, key):
+        self._lru.pop(key)
+
+    def get_version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def incr_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            return self._versions[namespace]
+
+    def size(self, namespace):
+        return len(self._lru)
+
+class SharedVersions:
+    """Versões de namespace lidas do backend e reutilizadas por CACHE_VERSION_TTL."""
+
+    def __init__(self):
+        self._versions = {}
+
+    def get_version(self, namespace):
+        item = self._versions.get(namespace)
+        if item and time.monotonic() - item[1] < CACHE_VERSION_TTL:
+            return item[0]
+        version = self._read_version(namespace)
+        self._versions[namespace] = (version, time.monotonic())
+        return version
+
+    def incr_version(self, namespace):
+        version = self._incr_version(namespace)
+        self._versions[namespace] = (version, time.monotonic())
+        return version
+
+class SQLiteFileStore:
+    """Ligação por thread a um ficheiro SQLite partilhado entre processos."""
+
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        con = self._connect()
+        for ddl in self.schema:
+            con.execute(ddl)
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+class SQLiteCacheBackend(SQLiteFileStore, SharedVersions):
+    """Backend num ficheiro SQLite, partilhado pelos workers da mesma máquina."""
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)",
+        "CREATE TABLE IF NOT EXISTS cache_version (namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+    )
+
+    def __init__(self, path, max_entries):
+        SQLiteFileStore.__init__(self, path)
+        SharedVersions.__init__(self)
+        self.max_entries = max_entries
+        self._writes = 0
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        con = self._connect()
+        con.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time() + ttl if ttl else None))
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            # INSERT OR REPLACE dá um rowid novo: os rowids mais baixos são os mais antigos
+            con.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            con.execute("DELETE FROM cache WHERE rowid <= (SELECT MAX(rowid) FROM cache) - ?",
+                        (self.max_entries,))
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _read_version(self, namespace):
+        row = self._connect().execute(
+            "SELECT version FROM cache_version WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def _incr_version(self, namespace):
+        con = self._connect()
+        con.execute("INSERT INTO cache_version (namespace, version) VALUES (?, 1) "
+                    "ON CONFLICT(namespace) DO UPDATE SET version = version + 1", (namespace,))
+        return self._read_version(namespace)
+
+    def size(self, namespace):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM cache WHERE key LIKE ?", (f"{CACHE_PREFIX}:{namespace}:%",)).fetchone()[0]
+
+class RedisCacheBackend(SharedVersions):
+    """Backend Redis; aceita qualquer cliente com get/set(ex=)/delete/incr."""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def get(self, key):
+        raw = self.client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def _read_version(self, namespace):
+        return int(self.client.get(f"{CACHE_PREFIX}:{namespace}:version") or 0)
+
+    def _incr_version(self, namespace):
+        return int(self.client.incr(f"{CACHE_PREFIX}:{namespace}:version"))
+
+    def size(self, namespace):
+        return None
+
+_shared_cache_backend = None
+
+def cache_backend(max_size):
+    """Backend para uma cache: LRU próprio em memória, ou o backend partilhado."""
+    global _shared_cache_backend
+    if CACHE_BACKEND == 'memory':
+        return MemoryCacheBackend(max_size)
+    if _shared_cache_backend is None:
+        if CACHE_BACKEND == 'sqlite':
+            _shared_cache_backend = SQLiteCacheBackend(CACHE_SQLITE_PATH, CACHE_SQLITE_MAX_ENTRIES)
+        elif CACHE_BACKEND == 'redis':
+            try:
+                import redis
+            except ImportError:
+                app.logger.warning('CACHE_BACKEND=redis sem o pacote redis; a usar cache em memória')
+                return MemoryCacheBackend(max_size)
+            _shared_cache_backend = RedisCacheBackend(redis.Redis.from_url(CACHE_REDIS_URL))
+        else:
+            raise ValueError(f"CACHE_BACKEND inválido: {CACHE_BACKEND}")
+    return _shared_cache_backend
+
+class Cache:
+    """Cache com namespace sobre um backend, com contadores por processo.
+
+    Os valores têm de ser serializáveis em JSON (os backends partilhados
+    guardam-nos assim); None não é guardado.
+    """
+
+    def __init__(self, namespace, backend, ttl=None):
+        self.namespace = namespace
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{CACHE_PREFIX}:{self.namespace}:{self.backend.get_version(self.namespace)}:{key}"
+
+    def get(self, key, default=None):
+        value = self.backend.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(self._key(key), value, ttl or self.ttl)
+
+    def pop(self, key):
+        self.backend.delete(self._key(key))
+
+    def clear(self):
+        """Invalida o namespace inteiro em todos os workers."""
+        self.backend.incr_version(self.namespace)
+
+    def size(self):
+        return self.backend.size(self.namespace)
+
+# Valores globais pequenos (ex.: id do utilizador público)
+app_cache = Cache('app', cache_backend(64))
 
 # --- Modelos ---
 class Feedback(db.Model):
+    # AUTOINCREMENT: ids apagados ou arquivados nunca são reutilizados
+    __table_args__ = (
+        db.Index('ix_feedback_data_hora', 'data', 'hora'),
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     grau_satisfacao = db.Column(db.String(20))
     data = db.Column(db.String(20))
     hora = db.Column(db.String(20))
     dia_semana = db.Column(db.String(20))
+    criado_em = db.Column(db.DateTime)
+
+class FeedbackRollup(db.Model):
+    """Contagens de Feedback por dia e grau, mantidas em cada submissão."""
+    __tablename__ = 'feedback_rollup'
+    data = db.Column(db.String(20), primary_key=True)
+    grau_satisfacao = db.Column(db.String(20), primary_key=True)
+    dia_semana = db.Column(db.String(20))
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+def rollup_add(data, grau, dia_semana, n=1):
+    """Soma n ao rollup de (data, grau) (sem commit)."""
+    updated = db.session.query(FeedbackRollup).filter_by(
+        data=data, grau_satisfacao=grau
+    ).update({FeedbackRollup.count: FeedbackRollup.count + n}, synchronize_session=False)
+    if not updated:
+        db.session.add(FeedbackRollup(data=data, grau_satisfacao=grau, dia_semana=dia_semana, count=n))
+
+def add_feedback_rows(rows):
+    """Insere vários feedbacks (dicts) e atualiza o rollup agregado (sem commit)."""
+    totals = {}
+    for row in rows:
+        db.session.add(Feedback(**row))
+        key = (row['data'], row['grau_satisfacao'])
+        if key in totals:
+            totals[key][1] += 1
+        else:
+            totals[key] = [row['dia_semana'], 1]
+    for (data, grau), (dia_semana, n) in totals.items():
+        rollup_add(data, grau, dia_semana, n)
+
+def rebuild_feedback_rollup():
+    """Recalcula o rollup a partir das linhas de Feedback (vivas e arquivadas)."""
+    db.session.query(FeedbackRollup).delete()
+    totals = {}
+    for model in (Feedback, FeedbackArchive):
+        rows = db.session.query(
+            model.data, model.grau_satisfacao,
+            func.max(model.dia_semana), func.count(model.id)
+        ).group_by(model.data, model.grau_satisfacao).all()
+        for data, grau, dia_semana, n in rows:
+            if (data, grau) in totals:
+                totals[(data, grau)][1] += n
+            else:
+                totals[(data, grau)] = [dia_semana, n]
+    for (data, grau), (dia_semana, n) in totals.items():
+        db.session.add(FeedbackRollup(data=data, grau_satisfacao=grau, dia_semana=dia_semana, count=n))
+    db.session.commit()
+    return len(totals)
+
+# Perfil de hash das palavras-passe, no formato do werkzeug
+# ("scrypt:N:r:p" ou "pbkdf2:sha256:iterações"). Hashes com outro perfil são
+# refeitos no próximo login com sucesso.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+_password_hash_prefix = None
+
+def password_hash_prefix():
+    """Prefixo normalizado do perfil atual (ex.: pbkdf2:sha256 -> pbkdf2:sha256:600000)."""
+    global _password_hash_prefix
+    if _password_hash_prefix is None:
+        _password_hash_prefix = generate_password_hash('', PASSWORD_HASH_METHOD).split('$', 1)[0]
+    return _password_hash_prefix
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -125,22 +845,34 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, PASSWORD_HASH_METHOD)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def password_needs_rehash(self):
+        return self.password_hash.split('$', 1)[0] != password_hash_prefix()
+
 
 class Medicamento(db.Model):
+    __table_args__ = (
+        db.Index('ix_medicamento_user_data_hora', 'user_id', 'data', 'hora'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     nome = db.Column(db.String(120), nullable=False)
     dose = db.Column(db.String(120), nullable=False)
     hora = db.Column(db.String(10), nullable=False)
     data = db.Column(db.String(10), nullable=True)
+    agendado_em = db.Column(db.DateTime, index=True)
 
 
 class Toma(db.Model):
+    __table_args__ = (
+        db.Index('ix_toma_user_data_hora', 'user_id', 'data', 'hora'),
+        db.Index('ix_toma_data_hora', 'data', 'hora'),
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     med_id = db.Column(db.Integer, db.ForeignKey('medicamento.id'), nullable=False)
@@ -149,68 +881,764 @@ class Toma(db.Model):
     data = db.Column(db.String(10), nullable=False)
     hora = db.Column(db.String(8), nullable=False)
     nota = db.Column(db.Text)
+    tomado_em = db.Column(db.DateTime)
+    agendado_em = db.Column(db.DateTime)
+
+# --- Adesão (agregados diários) ---
+# Cada toma conta para o dia em que foi registada; é "a tempo" se foi tomada
+# até ADHERENCE_TOLERANCE_MIN minutos antes ou depois da hora agendada,
+# "adiantada" ou "atrasada" fora disso. Tomas sem hora agendada só entram no
+# total.
+ADHERENCE_TOLERANCE_MIN = int(os.getenv('ADHERENCE_TOLERANCE_MIN', '30'))
+
+class AdherenceDaily(db.Model):
+    """Tomas por utilizador e dia, mantidas em cada registo de toma."""
+    __tablename__ = 'adherence_daily'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.String(10), primary_key=True)
+    tomadas = db.Column(db.Integer, nullable=False, default=0)
+    a_tempo = db.Column(db.Integer, nullable=False, default=0)
+    atrasadas = db.Column(db.Integer, nullable=False, default=0)
+    adiantadas = db.Column(db.Integer, nullable=False, default=0)
+
+def scheduled_for(med, when):
+    """Hora agendada de med para uma toma em `when`, ou None."""
+    if med is None:
+        return None
+    if med.agendado_em:
+        return med.agendado_em
+    return parse_datetime(when.strftime("%Y-%m-%d"), med.hora)
+
+def toma_timing(tomado_em, agendado_em):
+    """-1 (adiantada), 0 (a tempo) ou 1 (atrasada) conforme a tolerância, ou
+    None se faltar uma das horas."""
+    if tomado_em is None or agendado_em is None:
+        return None
+    tolerance = timedelta(minutes=ADHERENCE_TOLERANCE_MIN)
+    if tomado_em < agendado_em - tolerance:
+        return -1
+    if tomado_em > agendado_em + tolerance:
+        return 1
+    return 0
+
+def count_toma(counts, tomado_em, agendado_em):
+    """Soma uma toma a [tomadas, a_tempo, atrasadas, adiantadas]."""
+    timing = toma_timing(tomado_em, agendado_em)
+    counts[0] += 1
+    counts[1] += timing == 0
+    counts[2] += timing == 1
+    counts[3] += timing == -1
+
+def adherence_add(tomas):
+    """Soma as tomas dadas aos agregados diários (sem commit)."""
+    totals = {}
+    for t in tomas:
+        count_toma(totals.setdefault((t.user_id, t.data), [0, 0, 0, 0]), t.tomado_em, t.agendado_em)
+    for (user_id, data), (n, a_tempo, atrasadas, adiantadas) in totals.items():
+        updated = db.session.query(AdherenceDaily).filter_by(user_id=user_id, data=data).update({
+            AdherenceDaily.tomadas: AdherenceDaily.tomadas + n,
+            AdherenceDaily.a_tempo: AdherenceDaily.a_tempo + a_tempo,
+            AdherenceDaily.atrasadas: AdherenceDaily.atrasadas + atrasadas,
+            AdherenceDaily.adiantadas: AdherenceDaily.adiantadas + adiantadas,
+        }, synchronize_session=False)
+        if not updated:
+            db.session.add(AdherenceDaily(user_id=user_id, data=data, tomadas=n, a_tempo=a_tempo,
+                                          atrasadas=atrasadas, adiantadas=adiantadas))
+
+def rebuild_adherence():
+    """Recalcula os agregados a partir das tomas (vivas e arquivadas)."""
+    db.session.query(AdherenceDaily).delete()
+    totals = {}
+    for model in (Toma, TomaArchive):
+        rows = db.session.query(model.user_id, model.data, model.tomado_em, model.agendado_em) \
+            .yield_per(EXPORT_CHUNK_SIZE)
+        for user_id, data, tomado_em, agendado_em in rows:
+            count_toma(totals.setdefault((user_id, data), [0, 0, 0, 0]), tomado_em, agendado_em)
+    for (user_id, data), (n, a_tempo, atrasadas, adiantadas) in totals.items():
+        db.session.add(AdherenceDaily(user_id=user_id, data=data, tomadas=n, a_tempo=a_tempo,
+                                      atrasadas=atrasadas, adiantadas=adiantadas))
+    db.session.commit()
+    return len(totals)
+
+def adherence_summary(user_id, start, end, period):
+    """Tomas por dia/semana ISO/mês entre start e end (datas), a partir dos agregados."""
+    q = db.session.query(
+        AdherenceDaily.data,
+        func.sum(AdherenceDaily.tomadas), func.sum(AdherenceDaily.a_tempo),
+        func.sum(AdherenceDaily.atrasadas), func.sum(AdherenceDaily.adiantadas)
+    ).filter(AdherenceDaily.data >= start.isoformat(), AdherenceDaily.data <= end.isoformat())
+    if user_id is not None:
+        q = q.filter(AdherenceDaily.user_id == user_id)
+    buckets = {}
+    for data, *values in q.group_by(AdherenceDaily.data):
+        if period == 'week':
+            year, week, _ = date.fromisoformat(data).isocalendar()
+            key = f"{year}-W{week:02d}"
+        elif period == 'month':
+            key = data[:7]
+        else:
+            key = data
+        counts = buckets.setdefault(key, [0, 0, 0, 0])
+        for i, value in enumerate(values):
+            counts[i] += int(value or 0)
+
+    def entry(n, a_tempo, atrasadas, adiantadas):
+        avaliadas = a_tempo + atrasadas + adiantadas
+        return {
+            'tomadas': n,
+            'a_tempo': a_tempo,
+            'atrasadas': atrasadas,
+            'adiantadas': adiantadas,
+            'sem_horario': n - avaliadas,
+            'taxa_a_tempo': round(a_tempo / avaliadas, 4) if avaliadas else None
+        }
+
+    items = [{'periodo': key, **entry(*counts)} for key, counts in sorted(buckets.items())]
+    total = [sum(c[i] for c in buckets.values()) for i in range(4)]
+    return {
+        'period': period,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'items': items,
+        'total': entry(*total)
+    }
+
+# --- Arquivo (retenção) ---
+# Linhas de Toma/Feedback mais antigas que ARCHIVE_AFTER_DAYS passam, por
+# meses completos, para tabelas de arquivo com as mesmas colunas. O catálogo
+# archive_partition diz que meses existem no arquivo, para as queries só
+# lerem o arquivo quando o intervalo pedido lhe toca.
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))
+
+class TomaArchive(db.Model):
+    __tablename__ = 'toma_archive'
+    __table_args__ = (
+        db.Index('ix_toma_archive_user_data_hora', 'user_id', 'data', 'hora'),
+        db.Index('ix_toma_archive_data_hora', 'data', 'hora'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    med_id = db.Column(db.Integer, nullable=False)
+    nome = db.Column(db.String(120), nullable=False)
+    dose = db.Column(db.String(120), nullable=False)
+    data = db.Column(db.String(10), nullable=False)
+    hora = db.Column(db.String(8), nullable=False)
+    nota = db.Column(db.Text)
+    tomado_em = db.Column(db.DateTime)
+    agendado_em = db.Column(db.DateTime)
+
+class FeedbackArchive(db.Model):
+    __tablename__ = 'feedback_archive'
+    __table_args__ = (
+        db.Index('ix_feedback_archive_data_hora', 'data', 'hora'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    grau_satisfacao = db.Column(db.String(20))
+    data = db.Column(db.String(20))
+    hora = db.Column(db.String(20))
+    dia_semana = db.Column(db.String(20))
+    criado_em = db.Column(db.DateTime)
+
+class ArchivePartition(db.Model):
+    """Um mês arquivado de uma tabela (catálogo das partições)."""
+    __tablename__ = 'archive_partition'
+    tabela = db.Column(db.String(40), primary_key=True)
+    mes = db.Column(db.String(7), primary_key=True)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    archived_em = db.Column(db.DateTime)
+
+ARCHIVE_TABLES = (
+    ('toma', Toma, TomaArchive),
+    ('feedback', Feedback, FeedbackArchive),
+)
+
+def archive_in_range(tabela, first_month=None, last_month=None):
+    """True se há meses arquivados de `tabela` em [first_month, last_month]."""
+    q = db.session.query(ArchivePartition.mes).filter(ArchivePartition.tabela == tabela)
+    if first_month:
+        q = q.filter(ArchivePartition.mes >= first_month)
+    if last_month:
+        q = q.filter(ArchivePartition.mes <= last_month)
+    return q.first() is not None
+
+def toma_filters(model, user_id=None, month=None, start=None, end=None):
+    """Critérios de utilizador/datas para Toma ou TomaArchive.
+
+    O filtro de mês é um intervalo [início, mês seguinte) para usar os
+    índices (user_id, data, hora) / (data, hora) em vez de um LIKE.
+    """
+    criteria = []
+    if user_id is not None:
+        criteria.append(model.user_id == user_id)
+    if month:
+        bounds = month_bounds(month)
+        if bounds:
+            criteria += [model.data >= bounds[0], model.data < bounds[1]]
+        else:
+            criteria.append(model.data.startswith(month))
+    if start:
+        criteria.append(model.data >= start)
+    if end:
+        criteria.append(model.data <= end)
+    return criteria
+
+def tomas_query(user_id=None, month=None, start=None, end=None):
+    """Query de tomas filtrada por utilizador e intervalo de datas.
+
+    Devolve (query, entidade). Se o intervalo tocar meses arquivados, a
+    query corre sobre UNION ALL de toma e toma_archive, com os filtros
+    aplicados em cada ramo, e a entidade é um alias de Toma; as colunas
+    de ordenação/cursor devem vir dessa entidade.
+    """
+    args = (user_id, month, start, end)
+    if month and month_bounds(month):
+        first_month = last_month = month
+    else:
+        first_month = start[:7] if start else None
+        last_month = end[:7] if end else None
+    if not archive_in_range('toma', first_month, last_month):
+        return Toma.query.filter(*toma_filters(Toma, *args)), Toma
+    columns = [c.name for c in Toma.__table__.columns]
+    both = union_all(
+        select(*[Toma.__table__.c[c] for c in columns]).where(*toma_filters(Toma, *args)),
+        select(*[TomaArchive.__table__.c[c] for c in columns]).where(*toma_filters(TomaArchive, *args)),
+    ).subquery('toma_all')
+    entity = aliased(Toma, both)
+    return db.session.query(entity), entity
+
+def archive_old_rows(days=None):
+    """Move para o arquivo os meses completos anteriores ao horizonte.
+
+    Cada mês é copiado e apagado numa só transação. As tabelas vivas usam
+    AUTOINCREMENT (migração 9), por isso os ids movidos nunca voltam a ser
+    atribuídos. Devolve {tabela: linhas movidas}.
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = (date.today() - timedelta(days=days)).replace(day=1).isoformat()
+    moved = {}
+    for tabela, model, archive in ARCHIVE_TABLES:
+        moved[tabela] = 0
+        months = [m for (m,) in db.session.query(func.substr(model.data, 1, 7))
+                  .filter(model.data < cutoff).distinct().order_by(func.substr(model.data, 1, 7))]
+        columns = [c.name for c in model.__table__.columns]
+        for mes in months:
+            bounds = month_bounds(mes)
+            if not bounds:
+                continue
+            criteria = (model.data >= bounds[0], model.data < bounds[1])
+            user_ids = []
+            if model is Toma:
+                user_ids = [uid for (uid,) in db.session.query(Toma.user_id).filter(*criteria).distinct()]
+            db.session.execute(archive.__table__.insert().from_select(
+                columns, select(*[model.__table__.c[c] for c in columns]).where(*criteria)))
+            n = model.query.filter(*criteria).delete(synchronize_session=False)
+            if not n:
+                db.session.rollback()
+                continue
+            part = db.session.get(ArchivePartition, (tabela, mes))
+            if part is None:
+                db.session.add(ArchivePartition(tabela=tabela, mes=mes, rows=n, archived_em=datetime.now()))
+            else:
+                part.rows += n
+                part.archived_em = datetime.now()
+            if user_ids:
+                bump_data_version(*user_ids)
+            db.session.commit()
+            moved[tabela] += n
+    moved['change_log'] = prune_change_log()
+    return moved
+
+def backfill_timestamps(batch_size=1000):
+    """Preenche tomado_em/criado_em/agendado_em a partir das colunas de texto."""
+    total = 0
+    for model, col in ((Toma, 'tomado_em'), (Feedback, 'criado_em'), (Medicamento, 'agendado_em')):
+        column = getattr(model, col)
+        last_id = 0
+        # Só as colunas usadas: corre em migrações antes de colunas mais recentes existirem
+        table = model.__table__
+        stmt = table.update().where(table.c.id == bindparam('row_id')).values({col: bindparam('valor')})
+        while True:
+            rows = db.session.query(model.id, model.data, model.hora) \
+                .filter(column.is_(None), model.id > last_id) \
+                .order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            db.session.execute(stmt, [
+                {'row_id': row.id, 'valor': parse_datetime(row.data, row.hora)} for row in rows
+            ])
+            last_id = rows[-1].id
+            total += len(rows)
+            db.session.commit()
+    return total
+
+class DataVersion(db.Model):
+    """Contador de alterações por utilizador (user_id 0 = global)."""
+    __tablename__ = 'data_version'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+GLOBAL_VERSION_ID = 0
+
+def bump_data_version(*user_ids):
+    """Incrementa a versão dos utilizadores dados e a global (sem commit)."""
+    for uid in set(user_ids) | {GLOBAL_VERSION_ID}:
+        updated = db.session.query(DataVersion).filter_by(user_id=uid).update(
+            {DataVersion.version: DataVersion.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(DataVersion(user_id=uid, version=1))
+
+def get_data_version(user_id):
+    version = db.session.query(DataVersion.version).filter_by(user_id=user_id).scalar()
+    return version or 0
+
+class ChangeLog(db.Model):
+    """Registo de linhas de Medicamento/Toma alteradas, para /api/sync.
+
+    seq é AUTOINCREMENT: nunca é reutilizado, mesmo depois de limpar o log.
+    """
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_user_seq', 'user_id', 'seq'),
+        {'sqlite_autoincrement': True},
+    )
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    entidade = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    criado_em = db.Column(db.DateTime, nullable=False, index=True)
+
+CHANGE_LOG_ENTITIES = {Medicamento: 'medicamento', Toma: 'toma'}
+
+@event.listens_for(Session, 'after_flush')
+def change_log_after_flush(session, flush_context):
+    now = datetime.now()
+    rows = [
+        {'user_id': obj.user_id, 'entidade': CHANGE_LOG_ENTITIES[type(obj)], 'entity_id': obj.id, 'criado_em': now}
+        for objs in (session.new, session.dirty, session.deleted)
+        for obj in objs
+        if type(obj) in CHANGE_LOG_ENTITIES and (objs is not session.dirty or session.is_modified(obj))
+    ]
+    if rows:
+        session.connection().execute(ChangeLog.__table__.insert(), rows)
+
+def prune_change_log(days=None):
+    """Apaga entradas do log mais antigas que SYNC_LOG_DAYS, mantendo a última."""
+    days = SYNC_LOG_DAYS if days is None else days
+    head = db.session.query(func.max(ChangeLog.seq)).scalar()
+    if head is None:
+        return 0
+    n = ChangeLog.query.filter(
+        ChangeLog.seq < head,
+        ChangeLog.criado_em < datetime.now() - timedelta(days=days)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return n
+
+# --- Cache de identidade (User) ---
+# Sem password_hash: a cache pode ser partilhada (SQLite/Redis); o login e o
+# rehash leem o hash da BD
+USER_CACHE_COLUMNS = ('id', 'email', 'phone')
+user_cache = Cache(
+    'user',
+    cache_backend(int(os.getenv('USER_CACHE_SIZE', '1024'))),
+    ttl=float(os.getenv('USER_CACHE_TTL', '60'))
+)
+
+def get_user_cached(user_id):
+    """User por id, evitando a query à chave primária quando em cache.
+
+    A cache guarda só os valores das colunas; o objeto devolvido é ligado à
+    sessão atual com merge(load=False), sem SELECT.
+    """
+    values = user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        user_cache.set(user_id, {c: getattr(user, c) for c in USER_CACHE_COLUMNS})
+        return user
+    user = User(**{c: values[c] for c in USER_CACHE_COLUMNS if c in values})
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def invalidate_user_cache(user_id):
+    user_cache.pop(user_id)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return get_user_cached(int(user_id))
 
-# --- Criar DB se não existir ---
-with app.app_context():
-    db.create_all()
-    # Migração simples: adicionar coluna "nota" se não existir
+startup_phase('models')
+
+# --- Migrações ---
+# Cada migração é idempotente e corre uma só vez, por ordem de versão, sob
+# um lock entre processos. O arranque dos workers só lê a versão atual.
+AUTO_MIGRATE = os.getenv('AUTO_MIGRATE', 'true').lower() in ('1', 'true', 'yes', 'on')
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    applied_at = db.Column(db.DateTime)
+
+def add_column_if_missing(table, column, ddl_type):
+    cols = {c['name'] for c in inspect(db.engine).get_columns(table)}
+    if column not in cols:
+        quoted = db.engine.dialect.identifier_preparer.quote(table)
+        db.session.execute(text(f"ALTER TABLE {quoted} ADD COLUMN {column} {ddl_type}"))
+        db.session.commit()
+
+def migration_toma_nota():
+    add_column_if_missing('toma', 'nota', 'TEXT')
+
+def migration_user_phone():
+    add_column_if_missing('user', 'phone', 'TEXT')
+
+def migration_medicamento_data():
+    add_column_if_missing('medicamento', 'data', 'TEXT')
+
+def migration_typed_timestamps():
+    for table, col in (('toma', 'tomado_em'), ('feedback', 'criado_em'), ('medicamento', 'agendado_em')):
+        add_column_if_missing(table, col, 'TIMESTAMP')
+    for model in (Feedback, Medicamento, Toma):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    backfill_timestamps()
+
+def migration_feedback_rollup():
+    if not db.session.query(FeedbackRollup.data).first() and db.session.query(Feedback.id).first():
+        rebuild_feedback_rollup()
+
+def migration_archive_tables():
+    for model in (TomaArchive, FeedbackArchive, ArchivePartition):
+        model.__table__.create(db.engine, checkfirst=True)
+
+def migration_change_log():
+    ChangeLog.__table__.create(db.engine, checkfirst=True)
+
+def migration_adherence():
+    for table in ('toma', 'toma_archive'):
+        add_column_if_missing(table, 'agendado_em', 'TIMESTAMP')
+    AdherenceDaily.__table__.create(db.engine, checkfirst=True)
+    rebuild_adherence()
+
+def rebuild_with_autoincrement(model, archive):
+    """Recria a tabela de model com AUTOINCREMENT (SQLite).
+
+    Sem ele o SQLite atribui max(id) + 1, e um id apagado (ou arquivado) no
+    topo volta a ser usado. A sequência começa acima dos ids do arquivo.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    table = model.__table__
+    conn = db.session.connection()
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                       {'name': table.name}).scalar() or ''
+    if 'AUTOINCREMENT' not in ddl.upper():
+        old = f'{table.name}_old'
+        columns = ', '.join(f'"{c.name}"' for c in table.columns)
+        conn.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{old}"'))
+        # Os índices acompanham a tabela renomeada; os nomes ficam livres para a nova
+        for index in table.indexes:
+            conn.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+        table.create(conn)
+        conn.execute(text(f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "{old}"'))
+        conn.execute(text(f'DROP TABLE "{old}"'))
+    high = max(db.session.query(func.max(model.id)).scalar() or 0,
+               db.session.query(func.max(archive.id)).scalar() or 0)
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {'name': table.name})
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                 {'name': table.name, 'seq': high})
+    db.session.commit()
+
+def migration_autoincrement_ids():
+    for _, model, archive in ARCHIVE_TABLES:
+        rebuild_with_autoincrement(model, archive)
+
+MIGRATIONS = (
+    (1, migration_toma_nota),
+    (2, migration_user_phone),
+    (3, migration_medicamento_data),
+    (4, migration_typed_timestamps),
+    (5, migration_feedback_rollup),
+    (6, migration_archive_tables),
+    (7, migration_change_log),
+    (8, migration_adherence),
+    (9, migration_autoincrement_ids),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def current_schema_version():
+    """Versão aplicada, ou None se a tabela schema_version ainda não existe."""
     try:
-        cols = db.session.execute(text("PRAGMA table_info(toma)")).fetchall()
-        col_names = {c[1] for c in cols}
-        if cols and 'nota' not in col_names:
-            db.session.execute(text("ALTER TABLE toma ADD COLUMN nota TEXT"))
-            db.session.commit()
+        return db.session.query(SchemaVersion.version).filter_by(id=1).scalar() or 0
     except Exception:
         db.session.rollback()
-    # Migração simples: adicionar coluna "phone" em user se não existir
-    try:
-        cols = db.session.execute(text("PRAGMA table_info(user)")).fetchall()
-        col_names = {c[1] for c in cols}
-        if cols and 'phone' not in col_names:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN phone TEXT"))
+        return None
+
+@contextmanager
+def migration_lock():
+    """Lock exclusivo entre processos durante as migrações."""
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(20260001)"))
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(20260001)"))
+        return
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, 'migrate.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def run_migrations():
+    """Cria as tabelas em falta e aplica as migrações pendentes.
+
+    Devolve a lista de versões aplicadas.
+    """
+    applied = []
+    with migration_lock():
+        db.create_all()
+        state = db.session.get(SchemaVersion, 1)
+        if state is None:
+            state = SchemaVersion(id=1, version=0)
+            db.session.add(state)
             db.session.commit()
-    except Exception:
-        db.session.rollback()
-    # Migração simples: adicionar coluna "data" em medicamento se não existir
-    try:
-        cols = db.session.execute(text("PRAGMA table_info(medicamento)")).fetchall()
-        col_names = {c[1] for c in cols}
-        if cols and 'data' not in col_names:
-            db.session.execute(text("ALTER TABLE medicamento ADD COLUMN data TEXT"))
+        for version, migration in MIGRATIONS:
+            if version <= state.version:
+                continue
+            migration()
+            state.version = version
+            state.applied_at = datetime.now()
             db.session.commit()
-    except Exception:
-        db.session.rollback()
+            applied.append(version)
+    return applied
+
+with app.app_context():
+    version = current_schema_version()
+    if version is None or version < SCHEMA_VERSION:
+        if AUTO_MIGRATE:
+            run_migrations()
+        else:
+            app.logger.warning('Esquema da base de dados desatualizado; correr "flask db-migrate"')
     if PUBLIC_MODE:
         try:
             get_public_user()
         except Exception:
             db.session.rollback()
 
+startup_phase('migrations')
+
+# --- Assets estáticos ---
+# Ficheiros servidos com URL com hash (/assets/<hash>/<nome>) e cache imutável.
+ASSET_FILES = ('app.js', 'style.css', 'login.css', 'login.js', 'manifest.json')
+# Páginas cujas referências aos assets são reescritas para os URLs com hash.
+ASSET_PAGES = ('index.html', 'login.html')
+SERVICE_WORKER = 'service-worker.js'
+ASSET_MAX_AGE = 31536000
+# Feed SSE (/api/stream): cada separador aberto prende uma thread do worker e
+# o broker é por processo, por isso fica desligado por omissão. Ligar só com
+# um processo e workers gthread ou gevent (ver .env.example).
+STREAM_ENABLED = os.getenv('STREAM_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+# Configuração do cliente, injetada no app.js como APP_CONFIG
+APP_CONFIG = {'stream': STREAM_ENABLED}
+
+assets = {}
+assets_lock = threading.Lock()
+
+def asset_url(name):
+    asset = get_asset(name)
+    if not asset or name not in ASSET_FILES:
+        return '/' + name
+    return f"/assets/{asset['digest']}/{name}"
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+def build_asset_entry(name, body):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+        content_type += '; charset=utf-8'
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli:
+        variants['br'] = brotli.compress(body)
+    return {
+        'digest': hashlib.sha256(body).hexdigest()[:12],
+        'content_type': content_type,
+        'variants': variants,
+    }
+
+def build_assets():
+    """Lê, comprime (gzip/brotli) e calcula o hash de todos os assets."""
+    built = {}
+    mtimes = {}
+    for name in ASSET_FILES + ASSET_PAGES + (SERVICE_WORKER,):
+        path = os.path.join(app.root_path, name)
+        mtimes[name] = os.path.getmtime(path)
+    for name in ASSET_FILES:
+        with open(os.path.join(app.root_path, name), 'rb') as f:
+            body = f.read()
+        if name == 'app.js':
+            body = f"const APP_CONFIG = {json.dumps(APP_CONFIG)};\n".encode('utf-8') + body
+        built[name] = build_asset_entry(name, body)
+
+    def hashed(match):
+        attr, name = match.group(1), match.group(2)
+        return f'{attr}="/assets/{built[name]["digest"]}/{name}"'
+    pattern = re.compile(r'(href|src)="/?(%s)"' % '|'.join(re.escape(n) for n in ASSET_FILES))
+    for name in ASSET_PAGES:
+        with open(os.path.join(app.root_path, name), encoding='utf-8') as f:
+            html = pattern.sub(hashed, f.read())
+        built[name] = build_asset_entry(name, html.encode('utf-8'))
+
+    # Lista de pré-cache do service worker gerada a partir dos hashes
+    files = ['/', '/login'] + [f"/assets/{built[n]['digest']}/{n}" for n in ASSET_FILES]
+    version = hashlib.sha256('|'.join(files + [built[n]['digest'] for n in ASSET_PAGES]).encode()).hexdigest()[:12]
+    manifest = json.dumps({'version': version, 'files': files})
+    with open(os.path.join(app.root_path, SERVICE_WORKER), encoding='utf-8') as f:
+        sw = f"const ASSET_MANIFEST = {manifest};\n" + f.read()
+    built[SERVICE_WORKER] = build_asset_entry(SERVICE_WORKER, sw.encode('utf-8'))
+
+    with assets_lock:
+        assets.clear()
+        assets.update(built)
+        assets['_mtimes'] = mtimes
+
+def get_asset(name):
+    if app.debug and assets:
+        # Em desenvolvimento reconstrói quando algum ficheiro muda
+        for fname, mtime in assets['_mtimes'].items():
+            if os.path.getmtime(os.path.join(app.root_path, fname)) != mtime:
+                build_assets()
+                break
+    return assets.get(name)
+
+def serve_asset(name, immutable=False):
+    asset = get_asset(name)
+    accepted = request.accept_encodings
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and accepted[candidate]:
+            encoding = candidate
+            break
+    response = Response(asset['variants'][encoding], content_type=asset['content_type'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(f"{asset['digest']}-{encoding}")
+    if immutable:
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+try:
+    build_assets()
+except OSError:
+    app.logger.exception('Falha ao preparar os assets estáticos')
+startup_phase('assets')
+
 # --- Rotas públicas ---
 @app.route('/')
 @login_or_public
 def index():
-    return send_from_directory(app.root_path, 'index.html')
+    return serve_asset('index.html')
 
 @app.route('/index.html')
 @login_or_public
 def index_html():
-    return send_from_directory(app.root_path, 'index.html')
+    return serve_asset('index.html')
 
 @app.route('/login')
 def login_page():
-    return send_from_directory(app.root_path, 'login.html')
+    return serve_asset('login.html')
+
+@app.route('/assets/<digest>/<name>')
+def hashed_asset(digest, name):
+    asset = get_asset(name) if name in ASSET_FILES else None
+    if not asset or asset['digest'] != digest:
+        return "Not Found", 404
+    return serve_asset(name, immutable=True)
 
 @app.route('/<path:filename>')
 def static_files(filename):
-    # Serve arquivos estáticos (css/js/manifest) que estão na raiz do projeto
+    # Só os estáticos conhecidos (css/js/manifest) da raiz do projeto; o resto
+    # da raiz (app.py, .env, base de dados) nunca é servido
     if filename == 'index.html':
         return redirect(url_for('login_page'))
-    return send_from_directory(app.root_path, filename)
+    if filename in ASSET_FILES or filename == SERVICE_WORKER:
+        return serve_asset(filename)
+    return "Not Found", 404
+
+# --- Snapshot da base de dados ---
+DB_SNAPSHOT_DIR = os.getenv('DB_SNAPSHOT_DIR') or os.path.join(app.instance_path, 'snapshots')
+snapshot_lock = threading.Lock()
+
+def snapshot_fingerprint(source):
+    """Identifica o estado dos dados: versão global, maiores ids e ficheiros.
+
+    Nem todas as escritas mexem em data_version ou nos max(id) (reset de
+    palavra-passe, rehash no login, arquivo de feedback), por isso entram
+    também o tamanho e o mtime da BD e do WAL, que mudam em cada commit.
+    """
+    parts = [
+        get_data_version(GLOBAL_VERSION_ID),
+        db.session.query(func.max(Feedback.id)).scalar() or 0,
+        db.session.query(func.max(User.id)).scalar() or 0,
+    ]
+    for path in (source, source + '-wal'):
+        try:
+            st = os.stat(path)
+            parts += [st.st_size, st.st_mtime_ns]
+        except OSError:
+            parts += [0, 0]
+    return hashlib.sha1('-'.join(map(str, parts)).encode()).hexdigest()[:16]
+
+def get_db_snapshot(source):
+    """Cópia consistente da base de dados, refeita só quando os dados mudam.
+
+    Usa a API de backup online do SQLite, por isso escritas concorrentes não
+    deixam a cópia a meio. Devolve (caminho, fingerprint).
+    """
+    fingerprint = snapshot_fingerprint(source)
+    path = os.path.join(DB_SNAPSHOT_DIR, f'database-{fingerprint}.db')
+    if os.path.exists(path):
+        return path, fingerprint
+    with snapshot_lock:
+        if os.path.exists(path):
+            return path, fingerprint
+        os.makedirs(DB_SNAPSHOT_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=DB_SNAPSHOT_DIR, suffix='.tmp')
+        os.close(fd)
+        try:
+            src = sqlite3.connect(source)
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst)
+                dst.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                dst.close()
+                src.close()
+            os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # Snapshots antigos: quem já os está a descarregar mantém o ficheiro aberto
+        for name in os.listdir(DB_SNAPSHOT_DIR):
+            old = os.path.join(DB_SNAPSHOT_DIR, name)
+            if old != path and name.startswith('database-') and name.endswith('.db'):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+    return path, fingerprint
 
 @app.route('/public/db')
 def public_db_download():
@@ -221,128 +1649,420 @@ def public_db_download():
         return jsonify({'ok': False, 'message': 'Base de dados não é SQLite'}), 400
     if not os.path.exists(path):
         return jsonify({'ok': False, 'message': 'Base de dados não encontrada'}), 404
-    return send_file(path, mimetype='application/octet-stream', download_name='database.db', as_attachment=True)
+    snapshot, fingerprint = get_db_snapshot(path)
+    # conditional=True trata If-None-Match e Range (206) sobre o ficheiro estático
+    return send_file(snapshot, mimetype='application/octet-stream', download_name='database.db',
+                     as_attachment=True, conditional=True, etag=f'db-{fingerprint}')
+
+# --- Ingestão de feedback ---
+FEEDBACK_BUFFER = os.getenv('FEEDBACK_BUFFER', 'false').lower() in ('1', 'true', 'yes', 'on')
+FEEDBACK_BUFFER_SIZE = int(os.getenv('FEEDBACK_BUFFER_SIZE', '100'))
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv('FEEDBACK_FLUSH_INTERVAL', '2'))
+FEEDBACK_BATCH_MAX = 1000
+
+def feedback_row(grau, when):
+    return {
+        'grau_satisfacao': grau,
+        'data': when.strftime("%Y-%m-%d"),
+        'hora': when.strftime("%H:%M:%S"),
+        'dia_semana': when.strftime("%A"),
+        'criado_em': when.replace(microsecond=0)
+    }
+
+class FeedbackBuffer:
+    """Fila em memória de feedbacks gravada em lotes (write-behind).
+
+    Faz flush quando a fila atinge max_size ou a cada interval segundos,
+    e esvazia a fila no encerramento do processo. A thread de flush só
+    arranca no primeiro put() de cada processo, para funcionar com workers
+    criados por fork depois do import (gunicorn --preload).
+    """
+
+    def __init__(self, max_size, interval):
+        self.max_size = max_size
+        self.interval = interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.flushed = 0
+        self.errors = 0
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self.stop)
+            else:
+                # Processo filho: a thread do pai não existe aqui e as linhas
+                # herdadas são gravadas pelo pai
+                self._lock = threading.Lock()
+                self._flush_lock = threading.Lock()
+                self._wake = threading.Event()
+                self._stop = threading.Event()
+                self._rows = []
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='feedback-buffer', daemon=True)
+            self._thread.start()
+
+    def depth(self):
+        with self._lock:
+            return len(self._rows)
+
+    def put(self, row):
+        self.start()
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.max_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            with app.app_context():
+                try:
+                    add_feedback_rows(rows)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self.errors += 1
+                    app.logger.exception('Falha ao gravar lote de feedback')
+                    with self._lock:
+                        self._rows[:0] = rows
+                    return 0
+            self.flushed += len(rows)
+            return len(rows)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+feedback_buffer = FeedbackBuffer(FEEDBACK_BUFFER_SIZE, FEEDBACK_FLUSH_INTERVAL) if FEEDBACK_BUFFER else None
 
 @app.route('/submit_feedback', methods=['POST'])
 def submit_feedback():
     grau = request.form.get('grau')
-    now = datetime.now()
-    feedback = Feedback(
-        grau_satisfacao=grau,
-        data=now.strftime("%Y-%m-%d"),
-        hora=now.strftime("%H:%M:%S"),
-        dia_semana=now.strftime("%A")
-    )
-    db.session.add(feedback)
+    row = feedback_row(grau, datetime.now())
+    if feedback_buffer:
+        feedback_buffer.put(row)
+        return "ok"
+    add_feedback_rows([row])
     db.session.commit()
     return "ok"
 
+@app.route('/submit_feedback/batch', methods=['POST'])
+def submit_feedback_batch():
+    data = request.get_json(silent=True) or {}
+    votos = data.get('votos')
+    if not isinstance(votos, list) or not votos:
+        return jsonify({'ok': False, 'message': 'Lista de votos em falta'}), 400
+    if len(votos) > FEEDBACK_BATCH_MAX:
+        return jsonify({'ok': False, 'message': f'Máximo de {FEEDBACK_BATCH_MAX} votos por pedido'}), 400
+    rows = []
+    for i, voto in enumerate(votos):
+        grau = (voto.get('grau') or '').strip() if isinstance(voto, dict) else ''
+        if grau not in SATISFACAO_GRAUS:
+            return jsonify({'ok': False, 'message': f'Voto {i}: grau inválido'}), 400
+        when = datetime.now()
+        if voto.get('timestamp'):
+            try:
+                when = datetime.fromisoformat(voto['timestamp'])
+            except (TypeError, ValueError):
+                return jsonify({'ok': False, 'message': f'Voto {i}: timestamp inválido'}), 400
+        rows.append(feedback_row(grau, when))
+    add_feedback_rows(rows)
+    db.session.commit()
+    return jsonify({'ok': True, 'count': len(rows)})
+
+@app.route('/admin_2026/feedback/buffer')
+@admin_required
+def admin_feedback_buffer():
+    if not feedback_buffer:
+        return jsonify({'enabled': False, 'depth': 0})
+    return jsonify({
+        'enabled': True,
+        'depth': feedback_buffer.depth(),
+        'flushed': feedback_buffer.flushed,
+        'errors': feedback_buffer.errors,
+        'max_size': feedback_buffer.max_size,
+        'interval': feedback_buffer.interval
+    })
+
+# --- Respostas condicionais (ETag) ---
+json_cache = Cache(
+    'json',
+    cache_backend(int(os.getenv('JSON_CACHE_SIZE', '256'))),
+    ttl=float(os.getenv('JSON_CACHE_TTL', '3600'))
+)
+
+def data_scope_id():
+    """Âmbito dos dados visíveis: global em PUBLIC_MODE, senão o utilizador."""
+    return GLOBAL_VERSION_ID if PUBLIC_MODE else current_user.id
+
+def cached_json(name, build, vary=''):
+    """Responde com JSON cacheado pela versão dos dados, com ETag forte.
+
+    Um If-None-Match igual devolve 304 sem tocar nas tabelas; caso
+    contrário o corpo vem da cache LRU ou é construído por build().
+    `vary` junta à chave o que build() usa além da query string (ex.: datas
+    por omissão calculadas a partir de hoje).
+    """
+    scope_id = data_scope_id()
+    version = get_data_version(scope_id)
+    qs = hashlib.sha1(request.query_string + b'|' + vary.encode()).hexdigest()[:12]
+    etag = f"{name}-{scope_id}-{version}-{qs}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        key = f"{name}:{scope_id}:{qs}"
+        cached = json_cache.get(key)
+        if cached and cached[0] == version:
+            body = cached[1]
+        else:
+            body = app.json.dumps(build()) + "\n"
+            json_cache.set(key, [version, body])
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 # --- API medicamentos ---
+BATCH_MAX_OPS = 200
+
+def validate_med_payload(data):
+    """Valida nome/dose/hora/data; devolve (valores, None) ou (None, mensagem)."""
+    nome = (data.get('nome') or '').strip()
+    dose = (data.get('dose') or '').strip()
+    hora = (data.get('hora') or '').strip()
+    data_med = (data.get('data') or '').strip()
+    if not nome or not dose or not hora or not data_med:
+        return None, 'Nome, dose, hora e data são obrigatórios'
+    parsed_date = parse_date_ymd(data_med)
+    if not parsed_date:
+        return None, 'Data inválida'
+    if parsed_date < datetime.now().date():
+        return None, 'Não é possível marcar dias anteriores a hoje'
+    return {
+        'nome': nome,
+        'dose': dose,
+        'hora': hora,
+        'data': data_med or None,
+        'agendado_em': parse_datetime(data_med, hora)
+    }, None
+
+def visible_meds_query():
+    if PUBLIC_MODE:
+        return Medicamento.query
+    return Medicamento.query.filter_by(user_id=current_user.id)
+
+def valid_med_id(value):
+    """Ids de medicamento vindos de JSON: inteiros, sem aceitar true/false."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def find_med(med_id):
+    return visible_meds_query().filter_by(id=med_id).first()
+
+def visible_meds_by_id(values):
+    """{id: medicamento} dos ids válidos em values, numa só query."""
+    ids = {v for v in values if valid_med_id(v)}
+    return {m.id: m for m in visible_meds_query().filter(Medicamento.id.in_(ids))} if ids else {}
+
+def lookup_med(meds, value):
+    """meds[value] se value for um id válido (true não conta como 1), senão None."""
+    return meds.get(value) if valid_med_id(value) else None
+
+def record_toma(med, nota, user, now=None):
+    """Regista a toma de med e remove-o (sem commit)."""
+    now = now or datetime.now()
+    t = Toma(
+        user_id=user.id,
+        med_id=med.id,
+        nome=med.nome,
+        dose=med.dose,
+        nota=nota or None,
+        data=now.strftime("%Y-%m-%d"),
+        hora=now.strftime("%H:%M:%S"),
+        tomado_em=now.replace(microsecond=0),
+        agendado_em=scheduled_for(med, now)
+    )
+    db.session.add(t)
+    adherence_add([t])
+    # Remove medicamento (conforme pedido)
+    db.session.delete(med)
+    bump_data_version(med.user_id, user.id)
+    return t
+
 @app.route('/api/medicamentos', methods=['GET', 'POST'])
 @login_or_public
 def medicamentos_api():
     if request.method == 'POST':
-        data = request.get_json(silent=True) or {}
-        nome = (data.get('nome') or '').strip()
-        dose = (data.get('dose') or '').strip()
-        hora = (data.get('hora') or '').strip()
-        data_med = (data.get('data') or '').strip()
-        if not nome or not dose or not hora or not data_med:
-            return jsonify({'ok': False, 'message': 'Nome, dose, hora e data são obrigatórios'}), 400
-        parsed_date = parse_date_ymd(data_med)
-        if not parsed_date:
-            return jsonify({'ok': False, 'message': 'Data inválida'}), 400
-        if parsed_date < datetime.now().date():
-            return jsonify({'ok': False, 'message': 'Não é possível marcar dias anteriores a hoje'}), 400
+        values, error = validate_med_payload(request.get_json(silent=True) or {})
+        if error:
+            return jsonify({'ok': False, 'message': error}), 400
         user = effective_user()
-        med = Medicamento(user_id=user.id, nome=nome, dose=dose, hora=hora, data=data_med or None)
+        med = Medicamento(user_id=user.id, **values)
         db.session.add(med)
+        bump_data_version(user.id)
         db.session.commit()
         return jsonify({'ok': True, 'id': med.id})
 
-    if PUBLIC_MODE:
-        meds = Medicamento.query.all()
-    else:
-        meds = Medicamento.query.filter_by(user_id=current_user.id).all()
-    return jsonify([{
-        'id': m.id,
-        'nome': m.nome,
-        'dose': m.dose,
-        'hora': m.hora,
-        'data': m.data
-    } for m in meds])
+    def build():
+        meds = visible_meds_query().all()
+        return [{
+            'id': m.id,
+            'nome': m.nome,
+            'dose': m.dose,
+            'hora': m.hora,
+            'data': m.data
+        } for m in meds]
+    return cached_json('medicamentos', build)
 
 @app.route('/api/medicamentos/<int:med_id>', methods=['DELETE'])
 @login_or_public
 def medicamentos_delete(med_id):
-    if PUBLIC_MODE:
-        med = Medicamento.query.filter_by(id=med_id).first()
-    else:
-        med = Medicamento.query.filter_by(id=med_id, user_id=current_user.id).first()
+    med = find_med(med_id)
     if not med:
         return jsonify({'ok': False, 'message': 'Medicamento não encontrado'}), 404
     db.session.delete(med)
+    bump_data_version(med.user_id)
     db.session.commit()
     return jsonify({'ok': True})
 
 @app.route('/api/medicamentos/<int:med_id>/take', methods=['POST'])
 @login_or_public
 def medicamentos_take(med_id):
-    if PUBLIC_MODE:
-        med = Medicamento.query.filter_by(id=med_id).first()
-    else:
-        med = Medicamento.query.filter_by(id=med_id, user_id=current_user.id).first()
+    med = find_med(med_id)
     if not med:
         return jsonify({'ok': False, 'message': 'Medicamento não encontrado'}), 404
     data = request.get_json(silent=True) or {}
     nota = (data.get('nota') or '').strip()
-    # Regista toma
-    now = datetime.now()
-    user = effective_user()
-    t = Toma(
-        user_id=user.id,
-        med_id=med.id,
-        nome=med.nome,
-        dose=med.dose,
-        nota=nota or None,
-        data=now.strftime("%Y-%m-%d"),
-        hora=now.strftime("%H:%M:%S")
-    )
-    db.session.add(t)
-    # Remove medicamento (conforme pedido)
-    db.session.delete(med)
+    record_toma(med, nota, effective_user())
     db.session.commit()
     return jsonify({'ok': True})
 
 @app.route('/api/medicamentos/<int:med_id>', methods=['PUT'])
 @login_or_public
 def medicamentos_update(med_id):
-    if PUBLIC_MODE:
-        med = Medicamento.query.filter_by(id=med_id).first()
-    else:
-        med = Medicamento.query.filter_by(id=med_id, user_id=current_user.id).first()
+    med = find_med(med_id)
     if not med:
         return jsonify({'ok': False, 'message': 'Medicamento não encontrado'}), 404
-    data = request.get_json(silent=True) or {}
-    nome = (data.get('nome') or '').strip()
-    dose = (data.get('dose') or '').strip()
-    hora = (data.get('hora') or '').strip()
-    data_med = (data.get('data') or '').strip()
-    if not nome or not dose or not hora or not data_med:
-        return jsonify({'ok': False, 'message': 'Nome, dose, hora e data são obrigatórios'}), 400
-    parsed_date = parse_date_ymd(data_med)
-    if not parsed_date:
-        return jsonify({'ok': False, 'message': 'Data inválida'}), 400
-    if parsed_date < datetime.now().date():
-        return jsonify({'ok': False, 'message': 'Não é possível marcar dias anteriores a hoje'}), 400
-    med.nome = nome
-    med.dose = dose
-    med.hora = hora
-    med.data = data_med or None
+    values, error = validate_med_payload(request.get_json(silent=True) or {})
+    if error:
+        return jsonify({'ok': False, 'message': error}), 400
+    for key, value in values.items():
+        setattr(med, key, value)
+    bump_data_version(med.user_id)
     db.session.commit()
     return jsonify({'ok': True})
 
+@app.route('/api/medicamentos/batch', methods=['POST'])
+@login_or_public
+def medicamentos_batch():
+    """Aplica várias operações (create/update/delete/take) numa transação.
+
+    Corpo: {"ops": [{"op": "create", "nome", "dose", "hora", "data"},
+    {"op": "update", "id", ...}, {"op": "delete", "id"},
+    {"op": "take", "id", "nota"}]}. Operações inválidas são reportadas
+    no resultado do item e não impedem as restantes.
+    """
+    data = request.get_json(silent=True) or {}
+    ops = data.get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'ok': False, 'message': 'Lista de operações em falta'}), 400
+    if len(ops) > BATCH_MAX_OPS:
+        return jsonify({'ok': False, 'message': f'Máximo de {BATCH_MAX_OPS} operações por pedido'}), 400
+
+    meds = visible_meds_by_id(op.get('id') for op in ops if isinstance(op, dict))
+    user = effective_user()
+    now = datetime.now()
+    results = []
+    created = []
+    for op in ops:
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind == 'create':
+            values, error = validate_med_payload(op)
+            if error:
+                results.append({'ok': False, 'message': error})
+                continue
+            med = Medicamento(user_id=user.id, **values)
+            db.session.add(med)
+            bump_data_version(user.id)
+            created.append((len(results), med))
+            results.append({'ok': True})
+            continue
+        if kind not in ('update', 'delete', 'take'):
+            results.append({'ok': False, 'message': 'Operação inválida'})
+            continue
+        med = lookup_med(meds, op.get('id'))
+        if not med:
+            results.append({'ok': False, 'message': 'Medicamento não encontrado'})
+            continue
+        if kind == 'update':
+            values, error = validate_med_payload(op)
+            if error:
+                results.append({'ok': False, 'message': error})
+                continue
+            for key, value in values.items():
+                setattr(med, key, value)
+            bump_data_version(med.user_id)
+        elif kind == 'delete':
+            db.session.delete(med)
+            bump_data_version(med.user_id)
+            del meds[med.id]
+        else:
+            # data/hora opcionais: tomas feitas offline e reenviadas mais tarde
+            when = now
+            if op.get('data') or op.get('hora'):
+                when = parse_datetime(op.get('data'), op.get('hora'))
+                if not when:
+                    results.append({'ok': False, 'message': 'Data/hora inválida'})
+                    continue
+            record_toma(med, (op.get('nota') or '').strip(), user, when)
+            del meds[med.id]
+        results.append({'ok': True, 'id': med.id})
+    db.session.commit()
+    for index, med in created:
+        results[index]['id'] = med.id
+    return jsonify({'ok': all(r['ok'] for r in results), 'results': results})
+
 # --- API tomas (histórico) ---
+TOMA_FIELDS = ('id', 'med_id', 'nome', 'dose', 'data', 'hora', 'nota')
+TOMAS_PAGE_SIZE = 50
+TOMAS_PAGE_MAX = 500
+
+def encode_toma_cursor(data, hora, toma_id):
+    raw = f"{data}|{hora}|{toma_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_toma_cursor(cursor):
+    """Devolve (data, hora, id) a partir do cursor opaco, ou None."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        data, hora, toma_id = raw.split('|')
+        return data, hora, int(toma_id)
+    except Exception:
+        return None
+
 @app.route('/api/tomas', methods=['GET', 'POST'])
 @login_or_public
 def tomas_api():
@@ -355,6 +2075,9 @@ def tomas_api():
         now = datetime.now()
         if not med_id or not nome or not dose:
             return jsonify({'ok': False, 'message': 'Dados incompletos'}), 400
+        med = lookup_med(visible_meds_by_id([med_id]), med_id)
+        if not med:
+            return jsonify({'ok': False, 'message': 'Medicamento não encontrado'}), 404
         user = effective_user()
         t = Toma(
             user_id=user.id,
@@ -363,73 +2086,628 @@ def tomas_api():
             dose=dose,
             nota=nota or None,
             data=now.strftime("%Y-%m-%d"),
-            hora=now.strftime("%H:%M:%S")
+            hora=now.strftime("%H:%M:%S"),
+            tomado_em=now.replace(microsecond=0),
+            agendado_em=scheduled_for(med, now)
         )
         db.session.add(t)
+        adherence_add([t])
+        bump_data_version(user.id)
         db.session.commit()
         return jsonify({'ok': True, 'id': t.id})
 
-    month = request.args.get('month')
-    start = request.args.get('start')
-    end = request.args.get('end')
-    if PUBLIC_MODE:
-        q = Toma.query
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+        invalid = [f for f in fields if f not in TOMA_FIELDS]
+        if invalid:
+            return jsonify({'ok': False, 'message': f"Campos inválidos: {', '.join(invalid)}"}), 400
     else:
-        q = Toma.query.filter_by(user_id=current_user.id)
-    if month:
-        q = q.filter(Toma.data.startswith(month))
-    if start:
-        q = q.filter(Toma.data >= start)
-    if end:
-        q = q.filter(Toma.data <= end)
-    tomas = q.order_by(Toma.data.desc(), Toma.hora.desc()).all()
+        fields = list(TOMA_FIELDS)
+    limit = request.args.get('limit', type=int) or TOMAS_PAGE_SIZE
+    limit = max(1, min(limit, TOMAS_PAGE_MAX))
+    cursor = request.args.get('cursor')
+    key = None
+    if cursor:
+        key = decode_toma_cursor(cursor)
+        if not key:
+            return jsonify({'ok': False, 'message': 'Cursor inválido'}), 400
+
+    def build():
+        q, T = tomas_query(
+            user_id=None if PUBLIC_MODE else current_user.id,
+            month=request.args.get('month'),
+            start=request.args.get('start'),
+            end=request.args.get('end')
+        )
+        if key:
+            q = q.filter(tuple_(T.data, T.hora, T.id) < tuple_(*key))
+        # Colunas do cursor são sempre lidas, mesmo que não pedidas
+        columns = list(dict.fromkeys(['id', 'data', 'hora'] + fields))
+        rows = q.with_entities(*[getattr(T, c) for c in columns]) \
+            .order_by(T.data.desc(), T.hora.desc(), T.id.desc()) \
+            .limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_toma_cursor(last.data, last.hora, last.id)
+        return {
+            'items': [{f: getattr(r, f) for f in fields} for r in rows],
+            'next_cursor': next_cursor
+        }
+    return cached_json('tomas', build)
+
+@app.route('/api/tomas/days')
+@login_or_public
+def tomas_days_api():
+    """Dias distintos com tomas no intervalo (month ou start/end), para o calendário."""
+    def build():
+        q, T = tomas_query(
+            user_id=None if PUBLIC_MODE else current_user.id,
+            month=request.args.get('month'),
+            start=request.args.get('start'),
+            end=request.args.get('end')
+        )
+        rows = q.with_entities(T.data).distinct().order_by(T.data).all()
+        return {'days': [d for (d,) in rows if d]}
+    return cached_json('toma-days', build)
+
+@app.route('/api/tomas/batch', methods=['POST'])
+@login_or_public
+def tomas_batch():
+    """Regista várias tomas (sem remover o medicamento) numa transação.
+
+    Corpo: {"tomas": [{"med_id", "nome", "dose", "nota", "data", "hora"}]};
+    data/hora são opcionais e permitem reenviar tomas feitas offline.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('tomas')
+    if not isinstance(items, list) or not items:
+        return jsonify({'ok': False, 'message': 'Lista de tomas em falta'}), 400
+    if len(items) > BATCH_MAX_OPS:
+        return jsonify({'ok': False, 'message': f'Máximo de {BATCH_MAX_OPS} tomas por pedido'}), 400
+    user = effective_user()
+    now = datetime.now()
+    meds = visible_meds_by_id(item.get('med_id') for item in items if isinstance(item, dict))
+    results = []
+    created = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({'ok': False, 'message': 'Dados incompletos'})
+            continue
+        med_id = item.get('med_id')
+        nome = (item.get('nome') or '').strip()
+        dose = (item.get('dose') or '').strip()
+        if not med_id or not nome or not dose:
+            results.append({'ok': False, 'message': 'Dados incompletos'})
+            continue
+        med = lookup_med(meds, med_id)
+        if not med:
+            results.append({'ok': False, 'message': 'Medicamento não encontrado'})
+            continue
+        when = now
+        if item.get('data') or item.get('hora'):
+            when = parse_datetime(item.get('data'), item.get('hora'))
+            if not when:
+                results.append({'ok': False, 'message': 'Data/hora inválida'})
+                continue
+        t = Toma(
+            user_id=user.id,
+            med_id=med_id,
+            nome=nome,
+            dose=dose,
+            nota=(item.get('nota') or '').strip() or None,
+            data=when.strftime("%Y-%m-%d"),
+            hora=when.strftime("%H:%M:%S"),
+            tomado_em=when.replace(microsecond=0),
+            agendado_em=scheduled_for(med, when)
+        )
+        db.session.add(t)
+        created.append((len(results), t))
+        results.append({'ok': True})
+    if created:
+        adherence_add([t for _, t in created])
+        bump_data_version(user.id)
+    db.session.commit()
+    for index, t in created:
+        results[index]['id'] = t.id
+    return jsonify({'ok': all(r['ok'] for r in results), 'results': results})
+
+# --- Lembretes (agenda no servidor) ---
+def due_reminders(start, end, user_id=None):
+    """Medicamentos com start <= agendado_em <= end, por ordem.
+
+    Consulta de intervalo sobre o índice de agendado_em: O(log n + k) e
+    sempre atual, qualquer que seja o processo que escreveu.
+    """
+    q = Medicamento.query.filter(Medicamento.agendado_em.between(start, end))
+    if user_id is not None:
+        q = q.filter(Medicamento.user_id == user_id)
+    return q.order_by(Medicamento.agendado_em, Medicamento.id).all()
+
+REMINDER_WINDOW_MAX = 24 * 60
+# agendado_em é hora de parede do utilizador; sem tz_offset do cliente usa-se
+# este fuso (IANA, ex.: Europe/Lisbon) ou, vazio, o fuso do servidor
+REMINDER_TIMEZONE = os.getenv('REMINDER_TIMEZONE', '').strip()
+TZ_OFFSET_MAX = 14 * 60
+
+def reminder_now(tz_offset=None):
+    """Hora local do utilizador, sem tzinfo, para comparar com agendado_em.
+
+    tz_offset segue Date.getTimezoneOffset() do browser: minutos de UTC
+    menos a hora local (ex.: -60 em UTC+1).
+    """
+    if tz_offset is not None:
+        return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0) - timedelta(minutes=tz_offset)
+    if REMINDER_TIMEZONE:
+        from zoneinfo import ZoneInfo
+        return datetime.now(ZoneInfo(REMINDER_TIMEZONE)).replace(tzinfo=None, microsecond=0)
+    return datetime.now()
+
+@app.route('/api/reminders/due')
+@login_or_public
+def reminders_due():
+    """Medicamentos agendados entre agora - since e agora + window (minutos).
+
+    "Agora" é a hora local do cliente: tz_offset (minutos, como
+    Date.getTimezoneOffset()) ou, sem ele, REMINDER_TIMEZONE.
+    """
+    window = max(0, min(request.args.get('window', 1, type=int), REMINDER_WINDOW_MAX))
+    since = max(0, min(request.args.get('since', 1, type=int), REMINDER_WINDOW_MAX))
+    tz_offset = request.args.get('tz_offset', type=int)
+    if tz_offset is not None and abs(tz_offset) > TZ_OFFSET_MAX:
+        return jsonify({'ok': False, 'message': 'tz_offset inválido'}), 400
+    now = reminder_now(tz_offset)
+    due = due_reminders(now - timedelta(minutes=since), now + timedelta(minutes=window),
+                        user_id=None if PUBLIC_MODE else current_user.id)
     return jsonify([{
-        'id': t.id,
-        'med_id': t.med_id,
-        'nome': t.nome,
-        'dose': t.dose,
-        'data': t.data,
-        'hora': t.hora,
-        'nota': t.nota
-    } for t in tomas])
+        'id': m.id,
+        'nome': m.nome,
+        'dose': m.dose,
+        'hora': m.hora,
+        'data': m.data,
+        'agendado_em': m.agendado_em.isoformat()
+    } for m in due])
+
+# --- Feed de alterações (SSE) ---
+STREAM_HISTORY = int(os.getenv('STREAM_HISTORY', '500'))
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', '100'))
+STREAM_HEARTBEAT = 15
+# Os ids dos eventos são "<boot>-<seq>": um Last-Event-ID de outro processo
+# (ou de antes de um reinício) não corresponde a esta sequência e dá reset.
+STREAM_BOOT_ID = uuid.uuid4().hex[:8]
+
+class StreamSubscriber:
+    def __init__(self, channel, maxsize):
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.overflow = False
+
+class ChangeBroker:
+    """Pub/sub em processo com histórico curto por canal para retomar.
+
+    Os ids dos eventos são sequenciais neste processo (ver STREAM_BOOT_ID).
+    Um subscritor lento cujo buffer enche é marcado com overflow e recebe um
+    evento reset.
+    """
+
+    def __init__(self, history, queue_size):
+        self.history_size = history
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._history = {}    # canal -> deque[(id, tipo, dados)]
+        self._evicted = {}    # canal -> id do último evento descartado
+        self._subs = {}       # canal -> set(StreamSubscriber)
+
+    def publish(self, channel, kind, data):
+        with self._lock:
+            self._seq += 1
+            event = (self._seq, kind, data)
+            history = self._history.setdefault(channel, deque())
+            history.append(event)
+            if len(history) > self.history_size:
+                self._evicted[channel] = history.popleft()[0]
+            for sub in self._subs.get(channel, ()):
+                try:
+                    sub.queue.put_nowait(event)
+                except queue.Full:
+                    sub.overflow = True
+
+    def subscribe(self, channel, last_id=None):
+        """Devolve (subscritor, eventos a reenviar, precisa_reset)."""
+        with self._lock:
+            sub = StreamSubscriber(channel, self.queue_size)
+            self._subs.setdefault(channel, set()).add(sub)
+            backlog = []
+            reset = False
+            if last_id is not None:
+                if last_id < 0 or last_id > self._seq or last_id < self._evicted.get(channel, 0):
+                    reset = True
+                else:
+                    backlog = [e for e in self._history.get(channel, ()) if e[0] > last_id]
+            return sub, backlog, reset
+
+    def last_id(self):
+        with self._lock:
+            return self._seq
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.channel)
+            if subs:
+                subs.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subs.values())
+
+change_broker = ChangeBroker(STREAM_HISTORY, STREAM_QUEUE_SIZE)
+
+def med_event_data(med):
+    return {'id': med.id, 'nome': med.nome, 'dose': med.dose, 'hora': med.hora, 'data': med.data}
+
+def toma_event_data(t):
+    return {'id': t.id, 'med_id': t.med_id, 'nome': t.nome, 'dose': t.dose,
+            'data': t.data, 'hora': t.hora, 'nota': t.nota}
+
+@event.listens_for(Session, 'after_flush')
+def changes_after_flush(session, flush_context):
+    if not STREAM_ENABLED:
+        return
+    events = session.info.setdefault('change_events', [])
+    for obj in session.new:
+        if isinstance(obj, Medicamento):
+            events.append((obj.user_id, 'created', med_event_data(obj)))
+        elif isinstance(obj, Toma):
+            events.append((obj.user_id, 'taken', toma_event_data(obj)))
+    for obj in session.dirty:
+        if isinstance(obj, Medicamento) and session.is_modified(obj):
+            events.append((obj.user_id, 'updated', med_event_data(obj)))
+    for obj in session.deleted:
+        if isinstance(obj, Medicamento):
+            events.append((obj.user_id, 'deleted', {'id': obj.id}))
+
+@event.listens_for(Session, 'after_commit')
+def changes_after_commit(session):
+    for user_id, kind, data in session.info.pop('change_events', []):
+        change_broker.publish(user_id, kind, data)
+        change_broker.publish(GLOBAL_VERSION_ID, kind, data)
+
+@event.listens_for(Session, 'after_rollback')
+def changes_after_rollback(session):
+    session.info.pop('change_events', None)
+
+def format_sse(event_id, kind, data):
+    return f"id: {STREAM_BOOT_ID}-{event_id}\nevent: {kind}\ndata: {json.dumps(data)}\n\n"
+
+def parse_event_id(value):
+    """Seq deste processo a partir de um Last-Event-ID; None se não houver,
+    -1 se for de outro processo ou inválido (força reset)."""
+    if not value:
+        return None
+    boot, _, seq = value.rpartition('-')
+    if boot != STREAM_BOOT_ID or not seq.isdigit():
+        return -1
+    return int(seq)
+
+@app.route('/api/stream')
+@login_or_public
+def change_stream():
+    """Eventos created/updated/deleted/taken do utilizador em Server-Sent Events.
+
+    Só com STREAM_ENABLED; o app.js não liga o EventSource sem ele.
+    """
+    if not STREAM_ENABLED:
+        return jsonify({'ok': False, 'message': 'Feed de alterações desligado'}), 404
+    last_id = parse_event_id(request.headers.get('Last-Event-ID', request.args.get('last_id')))
+    sub, backlog, reset = change_broker.subscribe(data_scope_id(), last_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                # Com id desta sequência, para o próximo reconnect não repetir o reset
+                yield format_sse(change_broker.last_id(), 'reset', {})
+            for event_id, kind, data in backlog:
+                yield format_sse(event_id, kind, data)
+            while True:
+                try:
+                    event_id, kind, data = sub.queue.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if sub.overflow:
+                    # Perderam-se eventos: o cliente deve recarregar as listas
+                    while not sub.queue.empty():
+                        event_id = sub.queue.get_nowait()[0]
+                    sub.overflow = False
+                    yield format_sse(event_id, 'reset', {})
+                    continue
+                yield format_sse(event_id, kind, data)
+        finally:
+            change_broker.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# --- Estatísticas de adesão ---
+ADHERENCE_DEFAULT_DAYS = {'day': 30, 'week': 84, 'month': 365}
+
+@app.route('/api/stats/adherence')
+@login_or_public
+def adherence_stats_api():
+    """Tomas por dia, semana ou mês, a tempo, atrasadas e adiantadas, entre start e end."""
+    period = request.args.get('period', 'day')
+    if period not in ADHERENCE_DEFAULT_DAYS:
+        return jsonify({'ok': False, 'message': 'Período inválido (day, week ou month)'}), 400
+    end = date.today()
+    if request.args.get('end'):
+        end = parse_date_ymd(request.args.get('end'))
+    start = end - timedelta(days=ADHERENCE_DEFAULT_DAYS[period] - 1) if end else None
+    if request.args.get('start'):
+        start = parse_date_ymd(request.args.get('start'))
+    if not start or not end or start > end:
+        return jsonify({'ok': False, 'message': 'Intervalo de datas inválido'}), 400
+    user_id = None if PUBLIC_MODE else current_user.id
+    return cached_json('adherence', lambda: adherence_summary(user_id, start, end, period),
+                       vary=f'{start}|{end}')
+
+# --- Sincronização (réplica offline) ---
+SYNC_PAGE_MAX = 1000
+SYNC_INITIAL_DAYS = int(os.getenv('SYNC_INITIAL_DAYS', '90'))
+SYNC_LOG_DAYS = int(os.getenv('SYNC_LOG_DAYS', '30'))
+
+def encode_sync_cursor(head, desde, med_after, toma_after):
+    raw = f"{head}|{desde}|{med_after}|{toma_after}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_sync_cursor(cursor):
+    """Devolve (head, desde, med_after, toma_after) a partir do cursor, ou None."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        head, desde, med_after, toma_after = raw.split('|')
+        if not parse_date_ymd(desde):
+            return None
+        return int(head), desde, int(med_after), int(toma_after)
+    except Exception:
+        return None
+
+def sync_snapshot(head, desde=None, med_after=0, toma_after=0):
+    """Estado completo para uma réplica nova, em páginas de SYNC_PAGE_MAX linhas.
+
+    Medicamentos e depois tomas recentes, por id. A primeira página tem
+    reset=true; as seguintes pedem-se com ?snapshot=<cursor> até more=false.
+    version é o head do log no início da cópia: os deltas seguintes cobrem
+    o que mudou entretanto.
+    """
+    first = desde is None
+    if first:
+        desde = (date.today() - timedelta(days=SYNC_INITIAL_DAYS)).isoformat()
+    meds = visible_meds_query().filter(Medicamento.id > med_after) \
+        .order_by(Medicamento.id).limit(SYNC_PAGE_MAX + 1).all()
+    tomas = []
+    if len(meds) <= SYNC_PAGE_MAX:
+        q, T = tomas_query(user_id=None if PUBLIC_MODE else current_user.id, start=desde)
+        tomas = q.filter(T.id > toma_after).order_by(T.id) \
+            .limit(SYNC_PAGE_MAX - len(meds) + 1).all()
+    more = len(meds) + len(tomas) > SYNC_PAGE_MAX
+    meds = meds[:SYNC_PAGE_MAX]
+    tomas = tomas[:SYNC_PAGE_MAX - len(meds)]
+    cursor = None
+    if more:
+        cursor = encode_sync_cursor(head, desde, meds[-1].id if meds else med_after,
+                                    tomas[-1].id if tomas else toma_after)
+    return {
+        'reset': first,
+        'version': head,
+        'scope': data_scope_id(),
+        'tomas_desde': desde,
+        'medicamentos': [med_event_data(m) for m in meds],
+        'tomas': [toma_event_data(t) for t in tomas],
+        'deleted': {'medicamentos': [], 'tomas': []},
+        'more': more,
+        'cursor': cursor
+    }
+
+@app.route('/api/sync')
+@login_or_public
+def sync_api():
+    """Alterações de medicamentos e tomas desde uma versão ou instante.
+
+    `since` é o `version` devolvido na resposta anterior; `since_ts` (ISO)
+    serve para clientes sem versão. Sem ponto de partida, ou se o log já foi
+    limpo para lá dele, a resposta tem reset=true e o estado completo, paginado
+    por `cursor` (pedir ?snapshot=<cursor> enquanto more=true). Os itens vêm
+    no estado atual; ids que já não existem vêm em `deleted`.
+    """
+    snapshot = request.args.get('snapshot')
+    if snapshot:
+        state = decode_sync_cursor(snapshot)
+        if not state:
+            return jsonify({'ok': False, 'message': 'Cursor inválido'}), 400
+        return jsonify(sync_snapshot(*state))
+    since = request.args.get('since', type=int)
+    since_ts = request.args.get('since_ts')
+    head = db.session.query(func.max(ChangeLog.seq)).scalar() or 0
+    oldest = db.session.query(func.min(ChangeLog.seq)).scalar()
+    if since is None and since_ts:
+        try:
+            when = datetime.fromisoformat(since_ts)
+        except ValueError:
+            return jsonify({'ok': False, 'message': 'since_ts inválido'}), 400
+        first = db.session.query(func.min(ChangeLog.seq)).filter(ChangeLog.criado_em >= when).scalar()
+        since = head if first is None else first - 1
+    if since is None or since > head or (oldest is not None and since < oldest - 1):
+        return jsonify(sync_snapshot(head))
+
+    q = ChangeLog.query.filter(ChangeLog.seq > since)
+    if not PUBLIC_MODE:
+        q = q.filter(ChangeLog.user_id == current_user.id)
+    entries = q.order_by(ChangeLog.seq).limit(SYNC_PAGE_MAX + 1).all()
+    more = len(entries) > SYNC_PAGE_MAX
+    entries = entries[:SYNC_PAGE_MAX]
+    version = entries[-1].seq if more else head
+    med_ids = {e.entity_id for e in entries if e.entidade == 'medicamento'}
+    toma_ids = {e.entity_id for e in entries if e.entidade == 'toma'}
+    meds = visible_meds_query().filter(Medicamento.id.in_(med_ids)).all() if med_ids else []
+    tomas = []
+    if toma_ids:
+        tq = Toma.query.filter(Toma.id.in_(toma_ids))
+        if not PUBLIC_MODE:
+            tq = tq.filter(Toma.user_id == current_user.id)
+        tomas = tq.all()
+    return jsonify({
+        'reset': False,
+        'version': version,
+        'scope': data_scope_id(),
+        'medicamentos': [med_event_data(m) for m in meds],
+        'tomas': [toma_event_data(t) for t in tomas],
+        'deleted': {
+            'medicamentos': sorted(med_ids - {m.id for m in meds}),
+            'tomas': sorted(toma_ids - {t.id for t in tomas})
+        },
+        'more': more,
+        'cursor': None
+    })
 
 @app.route('/api/tomas/export')
 @login_or_public
 def tomas_export():
-    month = request.args.get('month')
-    start = request.args.get('start')
-    end = request.args.get('end')
-    if PUBLIC_MODE:
-        q = Toma.query
-    else:
-        q = Toma.query.filter_by(user_id=current_user.id)
-    if month:
-        q = q.filter(Toma.data.startswith(month))
-    if start:
-        q = q.filter(Toma.data >= start)
-    if end:
-        q = q.filter(Toma.data <= end)
-    tomas = q.order_by(Toma.data.desc(), Toma.hora.desc()).all()
+    q, T = tomas_query(
+        user_id=None if PUBLIC_MODE else current_user.id,
+        month=request.args.get('month'),
+        start=request.args.get('start'),
+        end=request.args.get('end')
+    )
+    q = q.order_by(T.data.desc(), T.hora.desc())
+    tipo = request.args.get('tipo', 'csv')
+    if tipo in COLUMNAR_FORMATS:
+        columns = ['id', 'med_id', 'nome', 'dose', 'data', 'hora', 'nota', 'tomado_em']
+        rows = q.with_entities(*[getattr(T, c) for c in columns]).yield_per(EXPORT_ROW_GROUP_SIZE)
+        return columnar_download(tipo, Toma, columns, rows, "historico_tomas")
+    if tipo != 'csv':
+        return jsonify({'ok': False, 'message': 'Tipo inválido'}), 400
+    q = q.yield_per(EXPORT_CHUNK_SIZE)
+    rows = ([t.id, t.nome, t.dose, t.data, t.hora, t.nota or ""] for t in q)
+    return stream_download(
+        iter_csv(['ID', 'Medicamento', 'Dose', 'Data', 'Hora', 'Nota'], rows),
+        "text/csv",
+        "historico_tomas.csv"
+    )
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Medicamento', 'Dose', 'Data', 'Hora', 'Nota'])
-    for t in tomas:
-        writer.writerow([t.id, t.nome, t.dose, t.data, t.hora, t.nota or ""])
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode()),
-        mimetype="text/csv",
-        download_name="historico_tomas.csv",
-        as_attachment=True
+# --- Limite de tentativas de login ---
+# Token bucket por IP e por email: cada tentativa gasta um token e os tokens
+# repõem-se a `per_minute` por minuto até `burst`. Limita o CPU gasto em
+# hashes por segundo. Com LOGIN_LIMIT_STORE=sqlite o estado é partilhado
+# entre workers num ficheiro SQLite próprio. O IP é remote_addr: atrás de um
+# proxy é preciso TRUSTED_PROXY_HOPS, senão todos partilham o bucket do proxy
+# (LOGIN_IP_PER_MINUTE=0 desliga o limite por IP).
+LOGIN_RATE_LIMIT = os.getenv('LOGIN_RATE_LIMIT', 'true').lower() in ('1', 'true', 'yes', 'on')
+LOGIN_LIMIT_STORE = os.getenv('LOGIN_LIMIT_STORE', 'memory')
+LOGIN_LIMIT_DB = os.getenv('LOGIN_LIMIT_DB') or os.path.join(app.instance_path, 'ratelimit.db')
+LOGIN_IP_PER_MINUTE = float(os.getenv('LOGIN_IP_PER_MINUTE', '30'))
+LOGIN_IP_BURST = float(os.getenv('LOGIN_IP_BURST', '20'))
+LOGIN_EMAIL_PER_MINUTE = float(os.getenv('LOGIN_EMAIL_PER_MINUTE', '6'))
+LOGIN_EMAIL_BURST = float(os.getenv('LOGIN_EMAIL_BURST', '6'))
+
+class MemoryBucketStore:
+    """Estado dos buckets em memória (por processo), com número de chaves limitado."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._data.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._data[key] = (tokens, now)
+            while len(self._data) > self.max_keys:
+                self._data.popitem(last=False)
+        return allowed, (0 if allowed else (1 - tokens) / rate)
+
+class SQLiteBucketStore(SQLiteFileStore):
+    """Estado dos buckets num ficheiro SQLite partilhado entre processos."""
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS bucket "
+        "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
     )
 
+    def take(self, key, rate, burst, now):
+        con = self._connect()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            con.execute("INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)",
+                        (key, tokens, now))
+            # Buckets cheios há mais de uma hora não guardam informação
+            if not row:
+                con.execute("DELETE FROM bucket WHERE updated < ?", (now - 3600,))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return allowed, (0 if allowed else (1 - tokens) / rate)
+
+_login_bucket_store = None
+
+def login_bucket_store():
+    global _login_bucket_store
+    if _login_bucket_store is None:
+        if LOGIN_LIMIT_STORE == 'sqlite':
+            _login_bucket_store = SQLiteBucketStore(LOGIN_LIMIT_DB)
+        else:
+            _login_bucket_store = MemoryBucketStore()
+    return _login_bucket_store
+
+def login_rate_limited(identity):
+    """Gasta um token do IP e um da identidade; devolve segundos de espera ou 0."""
+    if not LOGIN_RATE_LIMIT:
+        return 0
+    store = login_bucket_store()
+    now = time.time()
+    wait = 0
+    for key, per_minute, burst in (
+        (f'ip:{request.remote_addr}', LOGIN_IP_PER_MINUTE, LOGIN_IP_BURST),
+        (f'id:{identity}', LOGIN_EMAIL_PER_MINUTE, LOGIN_EMAIL_BURST),
+    ):
+        if per_minute <= 0:
+            continue
+        allowed, retry = store.take(key, per_minute / 60, burst, now)
+        if not allowed:
+            wait = max(wait, retry)
+    return wait
+
+def too_many_attempts(wait):
+    response = jsonify({'ok': False, 'message': 'Demasiadas tentativas. Tente novamente mais tarde.'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
+
 # --- Rotas admin ---
 @app.route('/admin_2026/login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
+        wait = login_rate_limited(f'admin:{username}')
+        if wait:
+            flash('Demasiadas tentativas. Tente novamente mais tarde.')
+            return render_template('admin_login.html'), 429, {'Retry-After': str(int(wait) + 1)}
         if username == 'admin' and password == '123':
             user = User.query.filter_by(email='admin@local').first()
             if not user:
@@ -449,87 +2727,187 @@ def admin_logout():
     logout_user()
     return redirect(url_for('admin_login'))
 
+ADMIN_USERS_PAGE_SIZE = 50
+SATISFACAO_GRAUS = ("Muito Satisfeito", "Satisfeito", "Insatisfeito")
+
+ADMIN_FEEDBACK_PAGE_SIZE = 100
+ADMIN_TOMAS_PAGE_SIZE = 100
+
+def feedback_stats():
+    """Contagens por grau de satisfação a partir do rollup diário."""
+    rows = db.session.query(FeedbackRollup.grau_satisfacao, func.sum(FeedbackRollup.count)) \
+        .group_by(FeedbackRollup.grau_satisfacao).all()
+    counts = {grau: int(n or 0) for grau, n in rows}
+    total = sum(counts.values())
+    stats = {'total': total}
+    for grau in SATISFACAO_GRAUS:
+        n = counts.get(grau, 0)
+        stats[grau] = {'count': n, 'pct': round(n / total * 100, 1) if total > 0 else 0}
+    return stats
+
+# dia_semana é gravado com strftime("%A"); ordem de segunda a domingo
+DIAS_SEMANA = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+def feedback_stats_by_weekday():
+    """Devolve [(dia_semana, {grau: count, 'total': n})] a partir do rollup, de segunda a domingo."""
+    rows = db.session.query(
+        FeedbackRollup.dia_semana, FeedbackRollup.grau_satisfacao, func.sum(FeedbackRollup.count)
+    ).group_by(FeedbackRollup.dia_semana, FeedbackRollup.grau_satisfacao).all()
+    out = {}
+    for dia, grau, n in rows:
+        counts = out.setdefault(dia, {'total': 0})
+        counts[grau] = int(n or 0)
+        counts['total'] += int(n or 0)
+    ordem = {dia: i for i, dia in enumerate(DIAS_SEMANA)}
+    return sorted(out.items(), key=lambda item: (ordem.get(item[0], len(ordem)), item[0] or ''))
+
+def feedback_page(before_id=None, limit=ADMIN_FEEDBACK_PAGE_SIZE):
+    """Página de feedback por cursor (id decrescente)."""
+    q = Feedback.query
+    if before_id:
+        q = q.filter(Feedback.id < before_id)
+    feedbacks = q.order_by(Feedback.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(feedbacks) > limit:
+        feedbacks = feedbacks[:limit]
+        next_cursor = feedbacks[-1].id
+    return feedbacks, next_cursor
+
+def user_counts(user_ids):
+    """Devolve {user_id: (meds, tomas)} com uma query agrupada por tabela."""
+    if not user_ids:
+        return {}
+    meds = dict(db.session.query(Medicamento.user_id, func.count(Medicamento.id))
+                .filter(Medicamento.user_id.in_(user_ids))
+                .group_by(Medicamento.user_id).all())
+    tomas = dict(db.session.query(Toma.user_id, func.count(Toma.id))
+                 .filter(Toma.user_id.in_(user_ids))
+                 .group_by(Toma.user_id).all())
+    if archive_in_range('toma'):
+        for uid, n in (db.session.query(TomaArchive.user_id, func.count(TomaArchive.id))
+                       .filter(TomaArchive.user_id.in_(user_ids))
+                       .group_by(TomaArchive.user_id)):
+            tomas[uid] = tomas.get(uid, 0) + n
+    return {uid: (meds.get(uid, 0), tomas.get(uid, 0)) for uid in user_ids}
+
+def users_page(before_id=None, limit=ADMIN_USERS_PAGE_SIZE):
+    """Página de utilizadores por cursor (id decrescente).
+
+    Devolve (users, next_cursor); next_cursor é None na última página.
+    """
+    q = User.query
+    if before_id:
+        q = q.filter(User.id < before_id)
+    users = q.order_by(User.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = users[-1].id
+    return users, next_cursor
+
 @app.route('/admin_2026')
 @admin_required
 def admin_dashboard():
     # Estatísticas básicas
-    total = Feedback.query.count()
-    muito_satisfeito = Feedback.query.filter_by(grau_satisfacao="Muito Satisfeito").count()
-    satisfeito = Feedback.query.filter_by(grau_satisfacao="Satisfeito").count()
-    insatisfeito = Feedback.query.filter_by(grau_satisfacao="Insatisfeito").count()
-    
-    # Percentagens
-    if total > 0:
-        pct_muito = round(muito_satisfeito / total * 100, 1)
-        pct_satisfeito = round(satisfeito / total * 100, 1)
-        pct_insatisfeito = round(insatisfeito / total * 100, 1)
-    else:
-        pct_muito = pct_satisfeito = pct_insatisfeito = 0
+    stats = feedback_stats()
 
-    feedbacks = Feedback.query.order_by(Feedback.data.desc(), Feedback.hora.desc()).all()
+    feedback_before = request.args.get('feedback_before', type=int)
+    feedbacks, feedback_next = feedback_page(feedback_before)
 
-    users = User.query.order_by(User.id.desc()).all()
+    before_id = request.args.get('users_before', type=int)
+    users, next_cursor = users_page(before_id)
+    counts = user_counts([u.id for u in users])
     users_data = []
     for u in users:
-        meds_count = Medicamento.query.filter_by(user_id=u.id).count()
-        tomas_count = Toma.query.filter_by(user_id=u.id).count()
+        meds_count, tomas_count = counts.get(u.id, (0, 0))
         users_data.append({
             'id': u.id,
             'email': u.email,
+            'phone': u.phone,
             'meds': meds_count,
             'tomas': tomas_count
         })
 
     return render_template('admin.html',
-                           total=total,
-                           muito_satisfeito=muito_satisfeito,
-                           satisfeito=satisfeito,
-                           insatisfeito=insatisfeito,
-                           pct_muito=pct_muito,
-                           pct_satisfeito=pct_satisfeito,
-                           pct_insatisfeito=pct_insatisfeito,
+                           total=stats['total'],
+                           muito_satisfeito=stats['Muito Satisfeito']['count'],
+                           satisfeito=stats['Satisfeito']['count'],
+                           insatisfeito=stats['Insatisfeito']['count'],
+                           pct_muito=stats['Muito Satisfeito']['pct'],
+                           pct_satisfeito=stats['Satisfeito']['pct'],
+                           pct_insatisfeito=stats['Insatisfeito']['pct'],
+                           weekday_stats=feedback_stats_by_weekday(),
                            feedbacks=feedbacks,
-                           users=users_data)
+                           feedback_next=feedback_next,
+                           feedback_paged=bool(feedback_before),
+                           users=users_data,
+                           users_next=next_cursor,
+                           users_paged=bool(before_id))
+
+@app.route('/admin_2026/startup')
+@admin_required
+def admin_startup():
+    return jsonify(startup_report())
+
+@app.route('/admin_2026/cache/stats')
+@admin_required
+def admin_cache_stats():
+    return jsonify({
+        'backend': CACHE_BACKEND,
+        **{name: {'size': cache.size(), 'hits': cache.hits, 'misses': cache.misses}
+           for name, cache in (('user', user_cache), ('json', json_cache), ('app', app_cache))}
+    })
+
+@app.route('/admin_2026/cache/clear', methods=['POST'])
+@admin_required
+def admin_cache_clear():
+    """Invalida todas as caches (em todos os workers, com backend partilhado)."""
+    for cache in (user_cache, json_cache, app_cache):
+        cache.clear()
+    return jsonify({'ok': True})
 
 # --- Exportação ---
 @app.route('/admin_2026/export/<tipo>')
 @admin_required
 def export_data(tipo):
-    feedbacks = Feedback.query.all()
-    df = pd.DataFrame([{
-        'ID': f.id,
-        'Grau Satisfacao': f.grau_satisfacao,
-        'Data': f.data,
-        'Hora': f.hora,
-        'Dia Semana': f.dia_semana
-    } for f in feedbacks])
-    
     if tipo == 'csv':
-        output = io.StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        return send_file(io.BytesIO(output.getvalue().encode()),
-                         mimetype="text/csv",
-                         download_name="feedback.csv",
-                         as_attachment=True)
+        delimiter, mimetype, download_name = ',', "text/csv", "feedback.csv"
     elif tipo == 'txt':
-        output = io.StringIO()
-        df.to_csv(output, index=False, sep='\t')
-        output.seek(0)
-        return send_file(io.BytesIO(output.getvalue().encode()),
-                         mimetype="text/plain",
-                         download_name="feedback.txt",
-                         as_attachment=True)
+        delimiter, mimetype, download_name = '\t', "text/plain", "feedback.txt"
+    elif tipo in COLUMNAR_FORMATS:
+        columns = [c.name for c in Feedback.__table__.columns]
+        queries = [model.query.with_entities(*[getattr(model, c) for c in columns])
+                   .order_by(model.id).yield_per(EXPORT_ROW_GROUP_SIZE)
+                   for model in (FeedbackArchive, Feedback)]
+        rows = (row for q in queries for row in q)
+        return columnar_download(tipo, Feedback, columns, rows, "feedback")
     else:
         return "Tipo inválido"
+    archived = FeedbackArchive.query.order_by(FeedbackArchive.id).yield_per(EXPORT_CHUNK_SIZE)
+    live = Feedback.query.order_by(Feedback.id).yield_per(EXPORT_CHUNK_SIZE)
+    rows = ([f.id, f.grau_satisfacao, f.data, f.hora, f.dia_semana] for q in (archived, live) for f in q)
+    header = ['ID', 'Grau Satisfacao', 'Data', 'Hora', 'Dia Semana']
+    return stream_download(iter_csv(header, rows, delimiter), mimetype, download_name)
 
 @app.route('/admin_2026/users/<int:user_id>')
 @admin_required
 def admin_user_detail(user_id):
     user = User.query.get_or_404(user_id)
     meds = Medicamento.query.filter_by(user_id=user_id).all()
-    tomas = Toma.query.filter_by(user_id=user_id).order_by(Toma.data.desc(), Toma.hora.desc()).all()
-    return render_template('admin_user.html', user=user, meds=meds, tomas=tomas)
+    cursor = request.args.get('tomas_before')
+    key = decode_toma_cursor(cursor) if cursor else None
+    q, T = tomas_query(user_id=user_id)
+    if key:
+        q = q.filter(tuple_(T.data, T.hora, T.id) < tuple_(*key))
+    tomas = q.order_by(T.data.desc(), T.hora.desc(), T.id.desc()).limit(ADMIN_TOMAS_PAGE_SIZE + 1).all()
+    tomas_next = None
+    if len(tomas) > ADMIN_TOMAS_PAGE_SIZE:
+        tomas = tomas[:ADMIN_TOMAS_PAGE_SIZE]
+        tomas_next = encode_toma_cursor(tomas[-1].data, tomas[-1].hora, tomas[-1].id)
+    today = date.today()
+    adesao = adherence_summary(user_id, today - timedelta(days=29), today, 'month')['total']
+    return render_template('admin_user.html', user=user, meds=meds, tomas=tomas,
+                           tomas_next=tomas_next, tomas_paged=bool(key), adesao=adesao)
 
 @app.route('/admin_2026/users/<int:user_id>/reset', methods=['POST'])
 @admin_required
@@ -553,43 +2931,155 @@ def admin_user_delete(user_id):
         return redirect(url_for('admin_dashboard'))
     Medicamento.query.filter_by(user_id=user_id).delete()
     Toma.query.filter_by(user_id=user_id).delete()
+    TomaArchive.query.filter_by(user_id=user_id).delete()
+    AdherenceDaily.query.filter_by(user_id=user_id).delete()
+    bump_data_version(user_id)
     db.session.delete(user)
     db.session.commit()
+    invalidate_user_cache(user_id)
     flash('Utilizador removido')
     return redirect(url_for('admin_dashboard'))
 
+EXPORT_ZIP_SPOOL_ROWS = int(os.getenv('EXPORT_ZIP_SPOOL_ROWS', '500000'))
+EXPORT_PROGRESS_TTL = 3600
+EXPORT_PROGRESS_INTERVAL = 0.5
+
+EXPORT_ALL_TABLES = (
+    ('users.csv', User, ['ID', 'Email'],
+     lambda u: [u.id, u.email]),
+    ('medicamentos.csv', Medicamento, ['ID', 'UserID', 'Nome', 'Dose', 'Hora', 'Data'],
+     lambda m: [m.id, m.user_id, m.nome, m.dose, m.hora, m.data or ""]),
+    ('tomas.csv', Toma, ['ID', 'UserID', 'MedID', 'Nome', 'Dose', 'Data', 'Hora', 'Nota'],
+     lambda t: [t.id, t.user_id, t.med_id, t.nome, t.dose, t.data, t.hora, t.nota or ""]),
+    ('tomas_arquivo.csv', TomaArchive, ['ID', 'UserID', 'MedID', 'Nome', 'Dose', 'Data', 'Hora', 'Nota'],
+     lambda t: [t.id, t.user_id, t.med_id, t.nome, t.dose, t.data, t.hora, t.nota or ""]),
+)
+
+# job_id -> {'done': bool, 'tables': {nome: {'done': n, 'total': n}}}
+# Na cache partilhada (CACHE_BACKEND) para o pedido de progresso poder cair
+# noutro worker; com CACHE_BACKEND=memory só funciona com um processo.
+export_progress = Cache('export', cache_backend(64), ttl=EXPORT_PROGRESS_TTL)
+# Jobs a correr neste processo: job_id -> [job, última publicação]
+_export_jobs = {}
+
+def export_progress_start(job_id, totals):
+    job = {
+        'done': False,
+        'tables': {name: {'done': 0, 'total': total} for name, total in totals.items()}
+    }
+    _export_jobs[job_id] = [job, time.monotonic()]
+    export_progress.set(job_id, job)
+
+def export_progress_update(job_id, name=None, done=None, finished=False):
+    """Atualiza o job; publica no máximo a cada EXPORT_PROGRESS_INTERVAL s."""
+    entry = _export_jobs.get(job_id)
+    if not entry:
+        return
+    job, published = entry
+    if name is not None:
+        job['tables'][name]['done'] = done
+    now = time.monotonic()
+    if finished:
+        job['done'] = True
+    elif now - published < EXPORT_PROGRESS_INTERVAL:
+        return
+    entry[1] = now
+    export_progress.set(job_id, job)
+
+class ZipStreamSink:
+    """Destino write-only (ZipFile, escritores Arrow); os bytes escritos são recolhidos com drain()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    @property
+    def closed(self):
+        return False
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def write_export_zip(fileobj, job_id):
+    """Escreve o ZIP tabela a tabela, lendo as linhas em blocos.
+
+    É um gerador: cede o controlo após cada bloco CSV comprimido, para o
+    chamador poder enviar o que já foi escrito em fileobj.
+    """
+    try:
+        with zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, model, header, row_fn in EXPORT_ALL_TABLES:
+                q = model.query.order_by(model.id).yield_per(EXPORT_CHUNK_SIZE)
+                done = 0
+
+                def rows():
+                    nonlocal done
+                    for obj in q:
+                        done += 1
+                        yield row_fn(obj)
+
+                with zf.open(name, mode='w', force_zip64=True) as entry:
+                    for chunk in iter_csv(header, rows()):
+                        entry.write(chunk.encode())
+                        export_progress_update(job_id, name, done)
+                        yield
+        export_progress_update(job_id, finished=True)
+        yield
+    finally:
+        # Download cancelado ou terminado: o job deixa de ser deste processo
+        _export_jobs.pop(job_id, None)
+
 @app.route('/admin_2026/export/all')
 @admin_required
 def export_all():
-    users = User.query.all()
-    meds = Medicamento.query.all()
-    tomas = Toma.query.all()
-
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
-        users_csv = io.StringIO()
-        w = csv.writer(users_csv)
-        w.writerow(['ID', 'Email'])
-        for u in users:
-            w.writerow([u.id, u.email])
-        zf.writestr('users.csv', users_csv.getvalue())
-
-        meds_csv = io.StringIO()
-        w = csv.writer(meds_csv)
-        w.writerow(['ID', 'UserID', 'Nome', 'Dose', 'Hora', 'Data'])
-        for m in meds:
-            w.writerow([m.id, m.user_id, m.nome, m.dose, m.hora, m.data or ""])
-        zf.writestr('medicamentos.csv', meds_csv.getvalue())
-
-        tomas_csv = io.StringIO()
-        w = csv.writer(tomas_csv)
-        w.writerow(['ID', 'UserID', 'MedID', 'Nome', 'Dose', 'Data', 'Hora', 'Nota'])
-        for t in tomas:
-            w.writerow([t.id, t.user_id, t.med_id, t.nome, t.dose, t.data, t.hora, t.nota or ""])
-        zf.writestr('tomas.csv', tomas_csv.getvalue())
-
-    mem.seek(0)
-    return send_file(mem, mimetype='application/zip', download_name='admin_export.zip', as_attachment=True)
+    job_id = request.args.get('job') or uuid.uuid4().hex
+    totals = {name: model.query.count() for name, model, _, _ in EXPORT_ALL_TABLES}
+    export_progress_start(job_id, totals)
+    headers = {'X-Export-Job': job_id}
+
+    if sum(totals.values()) > EXPORT_ZIP_SPOOL_ROWS or request.args.get('spool'):
+        # Exportações grandes: compõe o ZIP num ficheiro temporário e liberta a BD
+        spool = tempfile.TemporaryFile()
+        for _ in write_export_zip(spool, job_id):
+            pass
+        spool.seek(0)
+        response = send_file(spool, mimetype='application/zip', download_name='admin_export.zip', as_attachment=True)
+        response.headers.update(headers)
+        return response
+
+    def generate():
+        sink = ZipStreamSink()
+        for _ in write_export_zip(sink, job_id):
+            data = sink.drain()
+            if data:
+                yield data
+
+    headers['Content-Disposition'] = 'attachment; filename=admin_export.zip'
+    return Response(stream_with_context(generate()), mimetype='application/zip', headers=headers)
+
+@app.route('/admin_2026/export/all/progress/<job_id>')
+@admin_required
+def export_all_progress(job_id):
+    job = export_progress.get(job_id)
+    if not job:
+        return jsonify({'ok': False, 'message': 'Exportação não encontrada'}), 404
+    return jsonify({'ok': True, 'done': job['done'], 'tables': job['tables']})
 
 # --- Autenticação simples (login/registro) ---
 @app.route('/auth/register', methods=['POST'])
@@ -620,10 +3110,18 @@ def auth_login():
     if not email or not password:
         return jsonify({'ok': False, 'message': 'Email e palavra-passe são obrigatórios'}), 400
 
+    wait = login_rate_limited(email)
+    if wait:
+        return too_many_attempts(wait)
+
     user = User.query.filter_by(email=email).first()
     if not user or not user.check_password(password):
         return jsonify({'ok': False, 'message': 'Credenciais inválidas'}), 401
 
+    if user.password_needs_rehash():
+        user.set_password(password)
+        db.session.commit()
+
     login_user(user)
     return jsonify({'ok': True})
 
@@ -637,14 +3135,16 @@ def auth_logout():
 # --- Google OAuth ---
 @app.route('/auth/google')
 def auth_google():
-    if not oauth or not app.config['GOOGLE_CLIENT_ID'] or not app.config['GOOGLE_CLIENT_SECRET']:
+    oauth = get_oauth()
+    if not oauth:
         return "OAuth Google não configurado", 400
     redirect_uri = url_for('auth_google_callback', _external=True)
     return oauth.google.authorize_redirect(redirect_uri)
 
 @app.route('/auth/google/callback')
 def auth_google_callback():
-    if not oauth or not app.config['GOOGLE_CLIENT_ID'] or not app.config['GOOGLE_CLIENT_SECRET']:
+    oauth = get_oauth()
+    if not oauth:
         return "OAuth Google não configurado", 400
     token = oauth.google.authorize_access_token()
     userinfo = oauth.google.parse_id_token(token)
@@ -660,5 +3160,58 @@ def auth_google_callback():
     login_user(user)
     return redirect(url_for('index'))
 
+# --- Comandos CLI ---
+@app.cli.command('startup-report')
+def startup_report_command():
+    """Mostra o tempo e a memória gastos em cada fase do arranque."""
+    report = startup_report()
+    for phase in report['phases']:
+        print(f"{phase['phase']:<12} {phase['ms']:>8} ms  rss {phase['max_rss_kb']} KB  módulos {phase['modules']}")
+    print(f"{'total':<12} {report['total_ms']:>8} ms")
+
+@app.cli.command('db-migrate')
+def db_migrate_command():
+    """Aplica as migrações de esquema pendentes."""
+    applied = run_migrations()
+    if applied:
+        print(f"Migrações aplicadas: {', '.join(str(v) for v in applied)}")
+    print(f"Versão do esquema: {SCHEMA_VERSION}")
+
+@app.cli.command('backfill-timestamps')
+def backfill_timestamps_command():
+    """Preenche as colunas de data/hora tipadas em linhas antigas."""
+    n = backfill_timestamps()
+    print(f"Linhas atualizadas: {n}")
+
+@app.cli.command('rebuild-feedback-rollup')
+def rebuild_feedback_rollup_command():
+    """Reconstrói o rollup de feedback a partir das linhas existentes."""
+    n = rebuild_feedback_rollup()
+    print(f"Rollup reconstruído: {n} linhas")
+
+@app.cli.command('rebuild-adherence')
+def rebuild_adherence_command():
+    """Reconstrói os agregados diários de adesão a partir das tomas."""
+    n = rebuild_adherence()
+    print(f"Agregados reconstruídos: {n} linhas")
+
+@app.cli.command('prune-change-log')
+@click.option('--days', type=int, default=None, help='Dias a manter (por omissão SYNC_LOG_DAYS).')
+def prune_change_log_command(days):
+    """Limpa entradas antigas do log de alterações usado por /api/sync."""
+    print(f"Entradas removidas: {prune_change_log(days)}")
+
+@app.cli.command('archive-old-rows')
+@click.option('--days', type=int, default=None, help='Horizonte em dias (por omissão ARCHIVE_AFTER_DAYS).')
+def archive_old_rows_command(days):
+    """Move tomas e feedback antigos para as tabelas de arquivo."""
+    moved = archive_old_rows(days)
+    for tabela, n in moved.items():
+        print(f"{tabela}: {n} linhas arquivadas")
+
+startup_phase('routes')
+if os.getenv('STARTUP_REPORT', 'false').lower() in ('1', 'true', 'yes', 'on'):
+    app.logger.warning('Arranque: %s', startup_report())
+
 if __name__ == '__main__':
     app.run(debug=True)
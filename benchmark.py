@@ -0,0 +1,318 @@
+"""Benchmark e teste de carga dos endpoints Flask.
+
+Gera uma base de dados sintética (Feedback, Toma, Medicamento) com o
+tamanho pedido e mede cada endpoint de duas formas: pelo test client do
+Flask (sem rede) e por um servidor WSGI local com pedidos concorrentes.
+Os resultados (p50/p95/p99, throughput, memória) são gravados em JSON
+para comparar execuções.
+
+Exemplos:
+    python benchmark.py --rows 10k --output bench_10k.json
+    python benchmark.py --rows 1M --concurrency 16 --compare bench_10k.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000, '10M': 10_000_000}
+GRAUS = ('Muito Satisfeito', 'Satisfeito', 'Insatisfeito')
+INSERT_CHUNK = 50_000
+
+
+def parse_rows(value):
+    if value in SIZES:
+        return SIZES[value]
+    return int(value)
+
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(latencies, elapsed, errors):
+    ms = [v * 1000 for v in latencies]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(ms, 50), 3) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 3) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 3) if ms else None,
+        'mean_ms': round(statistics.fmean(ms), 3) if ms else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+# --- Dados sintéticos ---
+def generate_dataset(db_path, rows, seed=42):
+    """Insere `rows` linhas em cada tabela com executemany em blocos."""
+    rnd = random.Random(seed)
+    n_users = max(10, min(rows // 100, 10_000))
+    start = datetime.now() - timedelta(days=730)
+    con = sqlite3.connect(db_path)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=OFF")
+
+    con.executemany(
+        "INSERT INTO user (email, password_hash) VALUES (?, ?)",
+        ((f"bench{i}@local", "x") for i in range(n_users))
+    )
+    user_ids = [r[0] for r in con.execute("SELECT id FROM user")]
+
+    def chunks(make):
+        done = 0
+        while done < rows:
+            n = min(INSERT_CHUNK, rows - done)
+            yield [make() for _ in range(n)]
+            done += n
+
+    def feedback_row():
+        when = start + timedelta(seconds=rnd.randrange(730 * 86400))
+        return (rnd.choice(GRAUS), when.strftime("%Y-%m-%d"), when.strftime("%H:%M:%S"),
+                when.strftime("%A"), when.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def med_row():
+        when = datetime.now() + timedelta(minutes=rnd.randrange(60 * 24 * 90))
+        return (rnd.choice(user_ids), f"Med {rnd.randrange(500)}", f"{rnd.randrange(1, 10) * 100}mg",
+                when.strftime("%H:%M"), when.strftime("%Y-%m-%d"), when.strftime("%Y-%m-%d %H:%M:00"))
+
+    def toma_row():
+        when = start + timedelta(seconds=rnd.randrange(730 * 86400))
+        # Hora agendada até 2 h antes ou depois da toma: a tempo, atrasadas e adiantadas
+        scheduled = when + timedelta(minutes=rnd.randrange(-120, 121))
+        return (rnd.choice(user_ids), rnd.randrange(1, rows + 1), f"Med {rnd.randrange(500)}", "500mg",
+                when.strftime("%Y-%m-%d"), when.strftime("%H:%M:%S"), None,
+                when.strftime("%Y-%m-%d %H:%M:%S"), scheduled.strftime("%Y-%m-%d %H:%M:00"))
+
+    for batch in chunks(feedback_row):
+        con.executemany("INSERT INTO feedback (grau_satisfacao, data, hora, dia_semana, criado_em) "
+                        "VALUES (?, ?, ?, ?, ?)", batch)
+    for batch in chunks(med_row):
+        con.executemany("INSERT INTO medicamento (user_id, nome, dose, hora, data, agendado_em) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", batch)
+    for batch in chunks(toma_row):
+        con.executemany("INSERT INTO toma (user_id, med_id, nome, dose, data, hora, nota, tomado_em, agendado_em) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    # Versões de dados como se cada linha tivesse sido escrita pela app: uma por
+    # utilizador e a global (user_id 0), usadas nos ETags e na cache JSON
+    con.execute("DELETE FROM data_version")
+    con.execute("INSERT INTO data_version (user_id, version) "
+                "SELECT user_id, COUNT(*) FROM (SELECT user_id FROM medicamento "
+                "UNION ALL SELECT user_id FROM toma) GROUP BY user_id")
+    con.execute("INSERT INTO data_version (user_id, version) "
+                "SELECT 0, COALESCE(SUM(version), 0) FROM data_version")
+    con.commit()
+    con.execute("ANALYZE")
+    con.close()
+    return n_users
+
+
+# --- Cenários ---
+def scenarios():
+    """(nome, método, caminho, dados do formulário, requer admin)."""
+    month = datetime.now().strftime("%Y-%m")
+    today = datetime.now().date()
+    adherence = f"start={today - timedelta(days=729)}&end={today}"
+    return [
+        ('submit_feedback', 'POST', '/submit_feedback', {'grau': 'Satisfeito'}, False),
+        ('api_medicamentos', 'GET', '/api/medicamentos', None, False),
+        ('api_tomas_month', 'GET', f'/api/tomas?month={month}', None, False),
+        ('api_tomas_page', 'GET', '/api/tomas?limit=200', None, False),
+        ('api_adherence', 'GET', f'/api/stats/adherence?period=month&{adherence}', None, False),
+        ('admin_dashboard', 'GET', '/admin_2026', None, True),
+    ]
+
+
+def run_test_client(app_module, requests_per_endpoint):
+    """Pedidos sequenciais pelo test client; mede também o pico de memória."""
+    results = {}
+    client = app_module.app.test_client()
+    client.post('/admin_2026/login', data={'username': 'admin', 'password': '123'})
+    for name, method, path, form, _ in scenarios():
+        call = client.post if method == 'POST' else client.get
+        call(path, data=form)  # aquecimento
+        latencies = []
+        errors = 0
+        t0 = time.perf_counter()
+        for _ in range(requests_per_endpoint):
+            s = time.perf_counter()
+            r = call(path, data=form)
+            latencies.append(time.perf_counter() - s)
+            if r.status_code >= 400:
+                errors += 1
+        elapsed = time.perf_counter() - t0
+        tracemalloc.start()
+        call(path, data=form)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        summary = summarize(latencies, elapsed, errors)
+        summary['peak_alloc_kb'] = peak // 1024
+        results[name] = summary
+    return results
+
+
+def run_wsgi_server(app_module, requests_per_endpoint, concurrency):
+    """Pedidos concorrentes a um servidor WSGI local com threads."""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    jar = CookieJar()
+    admin_opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    admin_opener.open(base + '/admin_2026/login',
+                      urllib.parse.urlencode({'username': 'admin', 'password': '123'}).encode())
+    opener = urllib.request.build_opener()
+
+    results = {}
+    try:
+        for name, method, path, form, admin in scenarios():
+            use = admin_opener if admin else opener
+            body = urllib.parse.urlencode(form).encode() if method == 'POST' else None
+
+            def one(_):
+                s = time.perf_counter()
+                try:
+                    with use.open(base + path, body) as r:
+                        r.read()
+                        ok = r.status < 400
+                except Exception:
+                    ok = False
+                return time.perf_counter() - s, ok
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = list(pool.map(one, range(requests_per_endpoint)))
+            elapsed = time.perf_counter() - t0
+            summary = summarize([o[0] for o in outcomes], elapsed, sum(1 for o in outcomes if not o[1]))
+            summary['concurrency'] = concurrency
+            results[name] = summary
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(current, previous):
+    """Imprime a variação de p95 e throughput face a uma execução anterior."""
+    for mode in ('test_client', 'wsgi'):
+        for name, cur in current.get(mode, {}).items():
+            old = previous.get(mode, {}).get(name)
+            if not old or not old.get('p95_ms') or not cur.get('p95_ms'):
+                continue
+            d_p95 = (cur['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            d_rps = (cur['throughput_rps'] - old['throughput_rps']) / old['throughput_rps'] * 100
+            print(f"{mode:<12} {name:<18} p95 {d_p95:+6.1f}%  rps {d_rps:+6.1f}%")
+
+
+def print_table(results):
+    for mode, endpoints in results.items():
+        if not isinstance(endpoints, dict) or mode in ('meta',):
+            continue
+        print(f"\n[{mode}]")
+        print(f"{'endpoint':<18} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>9} {'err':>5}")
+        for name, r in endpoints.items():
+            print(f"{name:<18} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} "
+                  f"{r['throughput_rps']:>9} {r['errors']:>5}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='10k', help='linhas por tabela: 10k, 100k, 1M, 10M ou um número')
+    parser.add_argument('--requests', type=int, default=200, help='pedidos por endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='clientes concorrentes no modo WSGI')
+    parser.add_argument('--mode', choices=('all', 'test_client', 'wsgi'), default='all')
+    parser.add_argument('--db', help='reutilizar/criar a base de dados neste caminho')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='ficheiro JSON para gravar os resultados')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args(argv)
+
+    rows = parse_rows(args.rows)
+    db_path = os.path.abspath(args.db or os.path.join(tempfile.mkdtemp(prefix='lembreme-bench-'), 'bench.db'))
+    fresh = not os.path.exists(db_path)
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    os.environ.setdefault('PUBLIC_MODE', 'true')
+
+    t0 = time.perf_counter()
+    import app as app_module  # cria o esquema na base de dados indicada
+    import_ms = (time.perf_counter() - t0) * 1000
+
+    gen_s = 0.0
+    if fresh:
+        print(f"A gerar {rows} linhas por tabela em {db_path}...")
+        t0 = time.perf_counter()
+        generate_dataset(db_path, rows, args.seed)
+        with app_module.app.app_context():
+            app_module.rebuild_feedback_rollup()
+            app_module.rebuild_adherence()
+        gen_s = time.perf_counter() - t0
+
+    results = {'meta': {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'rows': rows,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'db': db_path,
+        'import_ms': round(import_ms, 1),
+        'generate_s': round(gen_s, 1),
+    }}
+    if args.mode in ('all', 'test_client'):
+        results['test_client'] = run_test_client(app_module, args.requests)
+    if args.mode in ('all', 'wsgi'):
+        results['wsgi'] = run_wsgi_server(app_module, args.requests, args.concurrency)
+    # ru_maxrss é o pico do processo inteiro, não de cada endpoint
+    results['meta']['max_rss_kb'] = max_rss_kb()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResultados gravados em {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        print()
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
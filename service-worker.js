@@ -1,19 +1,38 @@
-const CACHE_NAME = "lembreme-cache-v2";
+// ASSET_MANIFEST é injetado pelo servidor com os URLs com hash dos assets.
+const MANIFEST = typeof ASSET_MANIFEST !== "undefined" ? ASSET_MANIFEST : {
+  version: "dev",
+  files: [
+    "/",
+    "/login",
+    "login.css",
+    "style.css",
+    "login.js",
+    "app.js"
+  ]
+};
+const CACHE_NAME = `lembreme-cache-${MANIFEST.version}`;
+
+// Réplica local (IndexedDB) de medicamentos e tomas, atualizada por deltas de
+// /api/sync, e fila de alterações feitas sem rede, reenviadas em lote.
+const DB_NAME = "lembreme";
+const DB_VERSION = 1;
+const SYNC_TAG = "lembreme-sync";
+const SYNC_FRESH_MS = 2000;
+const BATCH_MAX_OPS = 200;
+const TOMAS_PAGE_SIZE = 50;
+const TOMAS_PAGE_MAX = 500;
+const TOMA_FIELDS = ["id", "med_id", "nome", "dose", "data", "hora", "nota"];
 
 self.addEventListener("install", e => {
   e.waitUntil(
-    caches.open(CACHE_NAME).then(cache => {
-      return cache.addAll([
-        "/",
-        "/login",
-        "login.html",
-        "index.html",
-        "login.css",
-        "style.css",
-        "login.js",
-        "app.js"
-      ]);
-    })
+    caches.open(CACHE_NAME).then(cache =>
+      Promise.all(MANIFEST.files.map(url =>
+        // Assets com hash inalterados são copiados da cache anterior
+        caches.match(url).then(hit =>
+          hit && url.startsWith("/assets/") ? cache.put(url, hit) : cache.add(url)
+        )
+      ))
+    )
   );
 });
 
@@ -26,7 +45,376 @@ self.addEventListener("activate", e => {
 });
 
 self.addEventListener("fetch", e => {
+  const url = new URL(e.request.url);
+  if (url.origin !== self.location.origin) return;
+  if (url.pathname.startsWith("/api/")) {
+    const handled = apiRequest(e.request, url);
+    if (handled) e.respondWith(handled);
+    return;
+  }
+  if (e.request.method !== "GET") return;
   e.respondWith(
     caches.match(e.request).then(res => res || fetch(e.request))
   );
 });
+
+self.addEventListener("sync", e => {
+  if (e.tag === SYNC_TAG) e.waitUntil(sincronizar(true));
+});
+
+self.addEventListener("message", e => {
+  if (e.data && e.data.type === "sync") e.waitUntil(sincronizar(true));
+});
+
+// --- IndexedDB ---
+let dbPromise = null;
+
+function abrirDb() {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve, reject) => {
+      const req = indexedDB.open(DB_NAME, DB_VERSION);
+      req.onupgradeneeded = () => {
+        const db = req.result;
+        db.createObjectStore("medicamentos", { keyPath: "id" });
+        db.createObjectStore("tomas", { keyPath: "id" });
+        db.createObjectStore("meta");
+        db.createObjectStore("pending", { keyPath: "seq", autoIncrement: true });
+      };
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => {
+        dbPromise = null;
+        reject(req.error);
+      };
+    });
+  }
+  return dbPromise;
+}
+
+function pedido(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+// Corre fn(stores) numa transação e resolve quando esta termina
+function transacao(nomes, mode, fn) {
+  return abrirDb().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction(nomes, mode);
+    const stores = {};
+    nomes.forEach(n => { stores[n] = tx.objectStore(n); });
+    let result;
+    Promise.resolve(fn(stores)).then(r => { result = r; }, err => { tx.abort(); reject(err); });
+    tx.oncomplete = () => resolve(result);
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  }));
+}
+
+function lerTodos(nome) {
+  return transacao([nome], "readonly", s => pedido(s[nome].getAll()));
+}
+
+function lerMeta() {
+  return transacao(["meta"], "readonly", s => pedido(s.meta.get("estado"))).then(m => m || {});
+}
+
+// --- Sincronização ---
+let syncEmCurso = null;
+let ultimaSync = 0;
+// Escritas feitas online desde o arranque; uma sync que comece antes de uma
+// escrita não conta como recente
+let escritas = 0;
+
+function sincronizar(forcar) {
+  if (syncEmCurso) return syncEmCurso;
+  if (!forcar && Date.now() - ultimaSync < SYNC_FRESH_MS) return Promise.resolve();
+  const inicio = escritas;
+  syncEmCurso = reenviar()
+    .then(enviados => puxar().then(() => {
+      ultimaSync = inicio === escritas ? Date.now() : 0;
+      if (enviados) avisarClientes();
+    }))
+    .finally(() => { syncEmCurso = null; });
+  return syncEmCurso;
+}
+
+function avisarClientes() {
+  self.clients.matchAll().then(list => list.forEach(c => c.postMessage({ type: "synced" })));
+}
+
+function erroHttp(res) {
+  // Redirecionamentos (sessão expirada) chegam como status 0
+  const err = new Error(`HTTP ${res.status}`);
+  err.status = res.status || 401;
+  return err;
+}
+
+// Deltas por `since` ou, sem réplica, a cópia completa por páginas
+// (?snapshot=<cursor>); ambos seguem enquanto more=true.
+async function puxar() {
+  let meta = await lerMeta();
+  let since = meta.version;
+  let cursor = null;
+  for (;;) {
+    const url = cursor ? `/api/sync?snapshot=${encodeURIComponent(cursor)}`
+      : since === undefined ? "/api/sync" : `/api/sync?since=${since}`;
+    const res = await fetch(url, { cache: "no-store", redirect: "manual" });
+    if (!res.ok) throw erroHttp(res);
+    const d = await res.json();
+    if (!d.reset && !cursor && meta.scope !== undefined && d.scope !== meta.scope) {
+      // Outra sessão: a réplica anterior não serve
+      meta = {};
+      since = undefined;
+      continue;
+    }
+    meta = await aplicarDelta(d, meta);
+    since = d.version;
+    cursor = d.cursor || null;
+    if (!d.more) break;
+  }
+}
+
+function aplicarDelta(d, meta) {
+  return transacao(["medicamentos", "tomas", "meta"], "readwrite", s => {
+    const novo = { ...meta, scope: d.scope };
+    if (d.reset) {
+      s.medicamentos.clear();
+      s.tomas.clear();
+      novo.tomas_desde = d.tomas_desde;
+      delete novo.version;
+    }
+    // A meio da cópia inicial a réplica está incompleta: a versão só fica
+    // gravada com a última página (uma cópia interrompida recomeça)
+    if (!d.cursor) novo.version = d.version;
+    d.medicamentos.forEach(m => s.medicamentos.put(m));
+    d.tomas.forEach(t => s.tomas.put(t));
+    d.deleted.medicamentos.forEach(id => s.medicamentos.delete(id));
+    d.deleted.tomas.forEach(id => s.tomas.delete(id));
+    s.meta.put(novo, "estado");
+    return novo;
+  });
+}
+
+// Reenvia a fila por ordem. Um lote fecha antes de uma operação que usa o id
+// temporário de um medicamento criado no mesmo lote, para o id real já ser
+// conhecido quando ela for enviada. Devolve o número de operações enviadas.
+async function reenviar() {
+  const pending = await lerTodos("pending");
+  const ids = new Map();
+  let enviados = 0;
+  let i = 0;
+  while (i < pending.length) {
+    const kind = pending[i].kind;
+    const lote = [];
+    const criados = new Set();
+    while (i < pending.length && pending[i].kind === kind && lote.length < BATCH_MAX_OPS) {
+      const p = pending[i];
+      const ref = kind === "med" ? p.op.id : p.op.med_id;
+      if (criados.has(ref)) break;
+      if (kind === "med" && p.op.op === "create") criados.add(p.temp_id);
+      lote.push(p);
+      i += 1;
+    }
+    const ops = lote.map(p => {
+      const op = { ...p.op };
+      if (kind === "med" && ids.has(op.id)) op.id = ids.get(op.id);
+      if (kind === "toma" && ids.has(op.med_id)) op.med_id = ids.get(op.med_id);
+      return op;
+    });
+    const url = kind === "med" ? "/api/medicamentos/batch" : "/api/tomas/batch";
+    const body = kind === "med" ? { ops } : { tomas: ops };
+    const res = await fetch(url, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(body),
+      redirect: "manual"
+    });
+    if (!res.ok && res.status !== 400) throw erroHttp(res);
+    const data = await res.json();
+    (data.results || []).forEach((r, j) => {
+      if (r.ok && kind === "med" && lote[j].op.op === "create") ids.set(lote[j].temp_id, r.id);
+    });
+    // Operações recusadas pelo servidor também saem da fila: não passariam depois
+    await transacao(["pending"], "readwrite", s => lote.forEach(p => s.pending.delete(p.seq)));
+    enviados += lote.length;
+  }
+  if (enviados) {
+    // As linhas provisórias (id negativo) voltam com o id real no próximo delta
+    await transacao(["medicamentos", "tomas"], "readwrite", s => {
+      const range = IDBKeyRange.upperBound(0, true);
+      s.medicamentos.delete(range);
+      s.tomas.delete(range);
+    });
+  }
+  return enviados;
+}
+
+// --- Pedidos à API ---
+function apiRequest(request, url) {
+  const path = url.pathname;
+  const method = request.method;
+  if (method === "GET" && path === "/api/medicamentos") {
+    return lerComReplica(request, () => lerTodos("medicamentos").then(meds =>
+      meds.map(({ id, nome, dose, hora, data }) => ({ id, nome, dose, hora, data }))
+    ));
+  }
+  if (method === "GET" && path === "/api/tomas") {
+    const cursor = url.searchParams.get("cursor");
+    if (cursor && !cursor.startsWith("local:")) return null;
+    return lerComReplica(request, meta => lerTomas(url, meta));
+  }
+  if (method === "GET" && path === "/api/tomas/days") {
+    return lerComReplica(request, meta => lerDiasTomas(url, meta));
+  }
+  if (method === "GET") return null;
+  const med = path.match(/^\/api\/medicamentos\/(-?\d+)(\/take)?$/);
+  if (path === "/api/medicamentos" && method === "POST") return mutacao(request, "med", "create");
+  if (path === "/api/medicamentos/batch" && method === "POST") return mutacao(request, "med", "batch");
+  if (path === "/api/tomas" && method === "POST") return mutacao(request, "toma", "create");
+  if (path === "/api/tomas/batch" && method === "POST") return mutacao(request, "toma", "batch");
+  if (med && med[2] && method === "POST") return mutacao(request, "med", "take", +med[1]);
+  if (med && !med[2] && method === "PUT") return mutacao(request, "med", "update", +med[1]);
+  if (med && !med[2] && method === "DELETE") return mutacao(request, "med", "delete", +med[1]);
+  return null;
+}
+
+function json(data, status) {
+  return new Response(JSON.stringify(data), {
+    status: status || 200,
+    headers: { "Content-Type": "application/json" }
+  });
+}
+
+async function lerComReplica(request, ler) {
+  try {
+    await sincronizar(false);
+  } catch (err) {
+    // Sem sessão: o servidor responde (401/redirect para o login)
+    if (err.status) return fetch(request);
+  }
+  const meta = await lerMeta();
+  if (meta.version === undefined) return fetch(request);
+  const data = await ler(meta);
+  return data === null ? fetch(request) : json(data);
+}
+
+// Página de tomas a partir da réplica, com a mesma forma de /api/tomas.
+// Devolve null se o intervalo pedido começa antes do que a réplica guarda.
+async function lerTomas(url, meta) {
+  const p = url.searchParams;
+  const month = p.get("month");
+  const start = p.get("start");
+  const end = p.get("end");
+  const inicio = start || (month ? `${month}-01` : null);
+  if (!inicio || !meta.tomas_desde || inicio < meta.tomas_desde) return null;
+  const fields = p.get("fields") ? p.get("fields").split(",").map(f => f.trim()).filter(Boolean) : TOMA_FIELDS;
+  const limit = Math.max(1, Math.min(+p.get("limit") || TOMAS_PAGE_SIZE, TOMAS_PAGE_MAX));
+  const cursor = p.get("cursor");
+  const key = cursor ? JSON.parse(cursor.slice("local:".length)) : null;
+  const antes = (t, k) => t.data < k[0] || (t.data === k[0] && (t.hora < k[1] || (t.hora === k[1] && t.id < k[2])));
+
+  const todas = await lerTodos("tomas");
+  const rows = todas
+    .filter(t => (!month || t.data.startsWith(month)) && (!start || t.data >= start) && (!end || t.data <= end))
+    .filter(t => !key || antes(t, key))
+    .sort((a, b) => b.data.localeCompare(a.data) || b.hora.localeCompare(a.hora) || b.id - a.id);
+  const page = rows.slice(0, limit);
+  const last = page[page.length - 1];
+  return {
+    items: page.map(t => Object.fromEntries(fields.map(f => [f, t[f] === undefined ? null : t[f]]))),
+    next_cursor: rows.length > limit ? `local:${JSON.stringify([last.data, last.hora, last.id])}` : null
+  };
+}
+
+// Dias distintos com tomas, com a mesma forma de /api/tomas/days.
+async function lerDiasTomas(url, meta) {
+  const p = url.searchParams;
+  const month = p.get("month");
+  const start = p.get("start");
+  const end = p.get("end");
+  const inicio = start || (month ? `${month}-01` : null);
+  if (!inicio || !meta.tomas_desde || inicio < meta.tomas_desde) return null;
+  const todas = await lerTodos("tomas");
+  const dias = new Set(todas
+    .filter(t => (!month || t.data.startsWith(month)) && (!start || t.data >= start) && (!end || t.data <= end))
+    .map(t => t.data));
+  return { days: [...dias].sort() };
+}
+
+// Tenta a rede; sem ligação guarda a operação na fila, aplica-a à réplica e
+// responde como o servidor responderia (202, queued: true).
+function mutacao(request, kind, action, id) {
+  const copia = request.clone();
+  return fetch(request).then(res => {
+    // A réplica ainda não tem esta escrita: a próxima leitura puxa o delta
+    if (res.ok) {
+      escritas += 1;
+      ultimaSync = 0;
+    }
+    return res;
+  }).catch(async () => {
+    const body = await copia.json().catch(() => ({}));
+    const agora = new Date();
+    // Data e hora locais (toISOString() daria a data em UTC)
+    const pad = n => String(n).padStart(2, "0");
+    const data = `${agora.getFullYear()}-${pad(agora.getMonth() + 1)}-${pad(agora.getDate())}`;
+    const hora = agora.toTimeString().slice(0, 8);
+    let ops;
+    if (kind === "toma") {
+      const items = action === "batch" ? body.tomas || [] : [body];
+      ops = items.map(t => ({ ...t, data: t.data || data, hora: t.hora || hora }));
+    } else if (action === "batch") {
+      ops = body.ops || [];
+    } else if (action === "create") {
+      ops = [{ op: "create", ...body }];
+    } else {
+      ops = [{ ...body, op: action, id }];
+    }
+    ops = ops.map(op => (op.op === "take" ? { data, hora, ...op } : op));
+    const results = await enfileirar(kind, ops);
+    if (self.registration.sync) self.registration.sync.register(SYNC_TAG).catch(() => {});
+    const resposta = action === "batch"
+      ? { ok: true, queued: true, results }
+      : { ok: true, queued: true, id: results[0].id };
+    return json(resposta, 202);
+  });
+}
+
+let tempSeq = 0;
+
+function idTemporario() {
+  tempSeq = (tempSeq + 1) % 1000;
+  return -(Date.now() * 1000 + tempSeq);
+}
+
+function enfileirar(kind, ops) {
+  return transacao(["pending", "medicamentos", "tomas"], "readwrite", async s => {
+    const results = [];
+    for (const op of ops) {
+      const entry = { kind, op };
+      let id = op.id;
+      if (kind === "toma") {
+        id = idTemporario();
+        s.tomas.put({ id, med_id: op.med_id, nome: op.nome, dose: op.dose,
+                      data: op.data, hora: op.hora, nota: op.nota || null });
+      } else if (op.op === "create") {
+        id = entry.temp_id = idTemporario();
+        s.medicamentos.put({ id, nome: op.nome, dose: op.dose, hora: op.hora, data: op.data });
+      } else if (op.op === "update") {
+        const atual = await pedido(s.medicamentos.get(op.id));
+        if (atual) s.medicamentos.put({ ...atual, nome: op.nome, dose: op.dose, hora: op.hora, data: op.data });
+      } else if (op.op === "delete" || op.op === "take") {
+        const atual = await pedido(s.medicamentos.get(op.id));
+        s.medicamentos.delete(op.id);
+        if (op.op === "take" && atual) {
+          s.tomas.put({ id: idTemporario(), med_id: op.id, nome: atual.nome, dose: atual.dose,
+                        data: op.data, hora: op.hora, nota: op.nota || null });
+        }
+      }
+      s.pending.add(entry);
+      results.push({ ok: true, id });
+    }
+    return results;
+  });
+}